@@ -0,0 +1,228 @@
+"""
+The whole server on CPython, driven by ftplib over loopback.
+
+    python benchmarks/loopback.py [--quick] [--ram] [--save FILE] [--against FILE]
+
+Reports RETR/STOR throughput, LIST latency against directory size and
+command round trip times, for each tx_size, maxbuf and maxcache setting.
+--save writes the results as json, --against compares a run with saved
+results and exits with 1 if anything got slower than --tolerance allows.
+--ram serves a ram_fs instead of a temporary directory, taking the
+host disk out of the numbers. Numbers are only comparable between runs on the same machine.
+"""
+
+import sys
+import json
+import socket
+import ftplib
+import argparse
+import threading
+from io import BytesIO
+from os import urandom
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+
+sys.path.insert(0, __file__.rsplit("/", 2)[0] + "/src")
+
+from ftp_server import ftp, ram_fs
+
+_port = 2100
+_pasv_port = 30100
+
+_tx_sizes = (512, 2048, 8192)
+_maxbufs = (1024, 2880)
+_maxcaches = (2, 4)
+_dir_sizes = (10, 100, 500)
+_commands = ("NOOP", "PWD", "TYPE I", "SIZE file.bin", "CWD .", "MLST file.bin")
+_slack = 0.2  # ms, timings this close are scheduler noise rather than regressions.
+
+
+class server:
+    # An ftp instance polled from a thread, for as long as the with block lasts.
+
+    def __init__(self, **kwargs) -> None:
+        global _port
+        _port += 1
+        self.port = _port
+        self.ftp = ftp(socket, "127.0.0.1", _port, **kwargs)
+        self.ftp.pasv_port = _pasv_port
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop:
+            self.ftp.poll()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stop = True
+        self._thread.join()
+        self.ftp.deinit()
+
+    def client(self, root):
+        c = ftplib.FTP()
+        c.connect("127.0.0.1", self.port, timeout=10)
+        c.login()
+        c.cwd(root)
+        return c
+
+
+def _best(func, repeat) -> float:
+    # Least time out of repeat runs, the least disturbed one.
+    took = None
+    for i in range(repeat):
+        start = perf_counter()
+        func()
+        end = perf_counter() - start
+        if took is None or end < took:
+            took = end
+    return took
+
+
+def _median(values) -> float:
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def throughput(c, data, repeat) -> tuple:
+    # STOR and RETR speed in MiB/s.
+    stor = _best(lambda: c.storbinary("STOR file.bin", BytesIO(data)), repeat)
+    retr = _best(lambda: c.retrbinary("RETR file.bin", lambda chunk: None), repeat)
+    return len(data) / stor / 1048576, len(data) / retr / 1048576
+
+
+def listing(srv, c, root, repeat) -> dict:
+    # LIST time in ms per directory size, cold and with the metadata cached.
+    res = {}
+    for size in _dir_sizes:
+        path = "%s/d%d" % (root, size)
+        srv.ftp.fs.mkdir(path)
+        for i in range(size):
+            srv.ftp.fs.open("%s/f%04d.txt" % (path, i), "wb").close()
+        cold = []
+        warm = []
+        for i in range(repeat):
+            srv.ftp.meta.clear()
+            start = perf_counter()
+            c.retrlines("LIST d%d" % size, lambda line: None)
+            cold.append(perf_counter() - start)
+            start = perf_counter()
+            c.retrlines("LIST d%d" % size, lambda line: None)
+            warm.append(perf_counter() - start)
+        res[size] = (_median(cold) * 1000, _median(warm) * 1000)
+    return res
+
+
+def round_trips(c, repeat) -> dict:
+    # Median command round trip in ms.
+    res = {}
+    for cmd in _commands:
+        times = []
+        for i in range(repeat * 10):
+            start = perf_counter()
+            c.sendcmd(cmd)
+            times.append(perf_counter() - start)
+        res[cmd] = _median(times) * 1000
+    return res
+
+
+def run(tx_size, maxbuf, maxcache, size, repeat, ram) -> dict:
+    root = "/bench" if ram else mkdtemp(prefix="ftp_bench_")
+    fs = ram_fs() if ram else None
+    if ram:
+        fs.mkdir(root)
+    try:
+        with server(maxbuf=maxbuf, maxcache=maxcache, fs=fs) as srv:
+            srv.ftp.tx_size = tx_size
+            c = srv.client(root)
+            stor, retr = throughput(c, urandom(size), repeat)
+            res = {
+                "stor": stor,
+                "retr": retr,
+                "list": listing(srv, c, root, repeat),
+                "rtt": round_trips(c, repeat),
+            }
+            c.quit()
+        return res
+    finally:
+        if not ram:
+            rmtree(root)
+
+
+def _key(tx_size, maxbuf, maxcache) -> str:
+    return "tx_size=%d maxbuf=%d maxcache=%d" % (tx_size, maxbuf, maxcache)
+
+
+def report(key, res) -> None:
+    print(key)
+    print("  STOR {:8.2f} MiB/s   RETR {:8.2f} MiB/s".format(res["stor"], res["retr"]))
+    for size, (cold, warm) in res["list"].items():
+        print("  LIST {:>4} files {:8.2f} ms cold {:8.2f} ms cached".format(size, cold, warm))
+    for cmd, took in res["rtt"].items():
+        print("  {:<14} {:8.3f} ms".format(cmd, took))
+
+
+def compare(results, baseline, tolerance) -> list:
+    # Everything that got worse than tolerance allows, as printable lines.
+    worse = []
+    for key, res in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        for name in ("stor", "retr"):  # Higher is better.
+            if res[name] < old[name] / tolerance:
+                worse.append("%s %s %.2f -> %.2f MiB/s" % (key, name, old[name], res[name]))
+        for size, (cold, warm) in res["list"].items():
+            was = old["list"].get(str(size))
+            if was is not None and cold > was[0] * tolerance + _slack:
+                worse.append("%s LIST %s %.2f -> %.2f ms" % (key, size, was[0], cold))
+        for cmd, took in res["rtt"].items():
+            was = old["rtt"].get(cmd)
+            if was is not None and took > was * tolerance + _slack:
+                worse.append("%s %s %.3f -> %.3f ms" % (key, cmd, was, took))
+    return worse
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--quick", action="store_true", help="one setting each, smaller file")
+    parser.add_argument("--ram", action="store_true", help="serve a ram_fs")
+    parser.add_argument("--size", type=int, default=1024, help="transfer size in KiB")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--against", help="compare with results saved by --save")
+    parser.add_argument(
+        "--tolerance", type=float, default=1.5, help="allowed slowdown factor (1.5)"
+    )
+    args = parser.parse_args()
+
+    grid = [(t, b, c) for t in _tx_sizes for b in _maxbufs for c in _maxcaches]
+    size = args.size * 1024
+    if args.quick:
+        grid = [(2048, 2880, 2)]
+        size = min(size, 256 * 1024)
+
+    results = {}
+    for setting in grid:
+        key = _key(*setting) + (" ram" if args.ram else "")
+        results[key] = run(*setting, size, args.repeat, args.ram)
+        report(key, results[key])
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.against:
+        with open(args.against) as f:
+            worse = compare(results, json.load(f), args.tolerance)
+        for line in worse:
+            print("SLOWER:", line)
+        if worse:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+RETR throughput, the streaming engine against the old read()/encode() loop.
+
+Runs on CPython, off-device:
+    python benchmarks/retr_throughput.py [file size in KiB]
+
+Both paths push the same file through a local socket pair into a reader
+thread that throws the data away, so only the server side is measured.
+In TYPE A the engine turns bare LF into CRLF and so sends more than the
+file holds, the old loop sent text as it was. Rates are in file MiB/s for both.
+"""
+
+import sys
+import socket
+import threading
+from gc import collect
+from os import remove, urandom
+from time import perf_counter
+
+sys.path.insert(0, __file__.rsplit("/", 2)[0] + "/src")
+
+from ftp_server import ftp, session
+
+_file = "/tmp/ftp_bench_retr.bin"
+_sizes = (512, 1024, 2048, 4096, 8192)
+
+
+def _drain(sock, total) -> None:
+    buf = bytearray(65536)
+    got = 0
+    while got < total:
+        got += sock.recv_into(buf)
+
+
+def _pair():
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    return a, b
+
+
+def legacy(tx_size, total, mode) -> float:
+    # The loop RETR used to run, kept here as the baseline.
+    a, b = _pair()
+    t = threading.Thread(target=_drain, args=(b, total))
+    t.start()
+    start = perf_counter()
+    if mode:  # Text mode, which never translated newlines.
+        f = open(_file, "r", encoding="latin-1", newline="")
+    else:
+        f = open(_file, "rb")
+    with f:
+        while True:
+            collect()
+            collect()
+            dat = f.read(tx_size)
+            if not dat:
+                break
+            if mode:
+                dat = dat.encode("latin-1")
+            res = 0
+            mv = memoryview(dat)
+            while res != len(dat):
+                try:
+                    res += a.send(mv[res:])
+                except OSError:
+                    pass
+            collect()
+    t.join()
+    took = perf_counter() - start
+    a.close()
+    b.close()
+    return took
+
+
+def engine(server, tx_size, total, mode) -> float:
+    # The real RETR path, driven one poll step at a time.
+    # total is what goes over the wire, see _wire_size.
+    server.tx_size = tx_size
+    a, b = _pair()
+    ctl, ctl_peer = _pair()
+    s = session(ctl, ("bench", 0), 0, True, mode)
+    s.pasv = True
+    s.data_socket = a
+    t = threading.Thread(target=_drain, args=(b, total))
+    t.start()
+    start = perf_counter()
+    server._retr(s, _file)
+    while s.xfer is not None:
+        server._step(s)
+    t.join()
+    took = perf_counter() - start
+    for i in (ctl, ctl_peer, b):
+        i.close()
+    return took
+
+
+def _wire_size(data, mode) -> int:
+    # Bytes the engine sends for data, TYPE A adds a CR to every bare LF.
+    if not mode:
+        return len(data)
+    return len(data) + data.count(b"\n") - data.count(b"\r\n")
+
+
+def main() -> None:
+    total = (int(sys.argv[1]) if len(sys.argv) > 1 else 256) * 1024
+    data = urandom(total)
+    with open(_file, "wb") as f:
+        f.write(data)
+    server = ftp(socket, "127.0.0.1", 0)
+    print("RETR of {} KiB, MiB/s".format(total // 1024))
+    print("{:>8} {:>6} {:>10} {:>10} {:>8}".format("tx_size", "type", "old", "new", "gain"))
+    try:
+        for mode in (False, True):
+            for size in _sizes:
+                old = total / legacy(size, total, mode) / 1048576
+                new = total / engine(server, size, _wire_size(data, mode), mode) / 1048576
+                print(
+                    "{:>8} {:>6} {:>10.1f} {:>10.1f} {:>7.1f}x".format(
+                        size, "A" if mode else "I", old, new, new / old
+                    )
+                )
+    finally:
+        server.deinit()
+        remove(_file)
+
+
+if __name__ == "__main__":
+    main()
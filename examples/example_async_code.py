@@ -0,0 +1,21 @@
+import wifi
+import asyncio
+from socketpool import SocketPool
+from ftp_server import ftp
+
+wifi.radio.connect("Your_wifi_ssid_here", "Your_wifi_passwd_here")
+
+pool = SocketPool(wifi.radio)
+my_ftp_server = ftp(pool, str(wifi.radio.ipv4_address))
+
+
+async def blink():  # Your other tasks.
+    while True:
+        await asyncio.sleep(1)
+
+
+async def main():
+    await asyncio.gather(my_ftp_server.serve_async(), blink())
+
+
+asyncio.run(main())
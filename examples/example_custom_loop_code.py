@@ -9,6 +9,10 @@ pool = SocketPool(wifi.radio)
 my_ftp_server = ftp(pool, str(wifi.radio.ipv4_address))
 
 while True: # Customise your condition.
-    my_ftp_server.poll()
+    # Sleeps up to 0.1s while idle, then works for about 5ms at most.
+    # Leave out budget_ms to move a single chunk per session.
+    my_ftp_server.poll(timeout=0.1, budget_ms=5)
+    if not my_ftp_server.pending:
+        pass # The server is idle, do your slower work here.
 
 my_ftp_server.deinit() # Cleanup
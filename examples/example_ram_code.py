@@ -0,0 +1,19 @@
+import wifi
+from socketpool import SocketPool
+from ftp_server import ftp, flash_fs, ram_fs, mount_fs
+
+wifi.radio.connect("Your_wifi_ssid_here", "Your_wifi_passwd_here")
+
+pool = SocketPool(wifi.radio)
+
+# Flash as usual, with a 32k RAM disk under /ram for data that doesn't need to survive a reset.
+ram = ram_fs(max_bytes=32768)
+my_ftp_server = ftp(
+    pool, str(wifi.radio.ipv4_address), fs=mount_fs({"/": flash_fs(), "/ram": ram})
+)
+
+while True:
+    with ram.open("/log.txt", "a") as f:  # Shows up as /ram/log.txt
+        f.write("Still alive!\n")
+    for i in range(1000):
+        my_ftp_server.poll()
@@ -1,40 +1,1357 @@
-from os import listdir, remove, getcwd, chdir, stat, mkdir, rmdir, rename
-from time import monotonic, localtime, sleep
-from storage import remount
+from os import listdir, remove, stat, mkdir, rmdir, rename
+from time import monotonic, monotonic_ns, localtime, time, sleep
 from gc import collect
+from collections import OrderedDict
+from binascii import hexlify, crc32
+
+try:
+    from storage import remount
+except ImportError:  # Not on CircuitPython, nothing to remount.
+    remount = None
+
+try:
+    from gc import mem_free, mem_alloc
+except ImportError:  # CPython
+    mem_free = mem_alloc = None
+
+try:
+    from io import IOBase
+except ImportError:
+    IOBase = object
 
 _enc = "UTF-8" # We currently only support UTF-8
 
 _msgs = [ # The message board.
-    b"501 Syntax error in parameters or arguments.",  # 0
-    b"230 User logged in, proceed.",  # 1
-    b"331 User name okay, need password.",  # 2
-    b"220 Welcome!",  # 3
-    b"215 UNIX Type: L8.",  # 4
-    b"550 Failed Directory not exists.",  # 5
-    b"250 Command successful.",  # 6
-    b"530 User not logged in.",  # 7
-    b"150 Here is listing.",  # 8
-    b"550 LIST failed Path name not exists.",  # 9
-    b"226 List done.",  # 10
-    b"200 Get port.",  # 11
-    b"200 Binary mode.",  # 12
-    b"200 Ascii mode.",  # 13
-    b"200 Ok.",  # 14
-    b"221 Goodbye!",  # 15
-    b"421 Service not available.",  # 16
-    b"150 Here is the file.",  # 17
-    b"550 File not found",  # 18
-    b"226 Transfer complete",  # 19
-    b"550 Requested action not taken. File storage is not allowed on this server.",  # 20
-    b"550 Directory not empty",  # 21
-    b"350 File or directory exists, ready for destination name.",  # 22
-    b"553 Requested action not taken. File name not allowed.",  # 23
-    b"350 Ready for RNTO.",  # 24
-    b"451 Requested action aborted: local error in processing.",  # 25
-    b"226 Aborted.", # 26
+    b"501 Syntax error in parameters or arguments.\r\n",  # 0
+    b"230 User logged in, proceed.\r\n",  # 1
+    b"331 User name okay, need password.\r\n",  # 2
+    b"220 Welcome!\r\n",  # 3
+    b"215 UNIX Type: L8.\r\n",  # 4
+    b"550 Failed Directory not exists.\r\n",  # 5
+    b"250 Command successful.\r\n",  # 6
+    b"530 User not logged in.\r\n",  # 7
+    b"150 Here is listing.\r\n",  # 8
+    b"550 LIST failed Path name not exists.\r\n",  # 9
+    b"226 List done.\r\n",  # 10
+    b"200 Get port.\r\n",  # 11
+    b"200 Binary mode.\r\n",  # 12
+    b"200 Ascii mode.\r\n",  # 13
+    b"200 Ok.\r\n",  # 14
+    b"221 Goodbye!\r\n",  # 15
+    b"421 Service not available.\r\n",  # 16
+    b"150 Here is the file.\r\n",  # 17
+    b"550 File not found\r\n",  # 18
+    b"226 Transfer complete\r\n",  # 19
+    b"550 Requested action not taken. File storage is not allowed on this server.\r\n",  # 20
+    b"550 Directory not empty\r\n",  # 21
+    b"350 File or directory exists, ready for destination name.\r\n",  # 22
+    b"553 Requested action not taken. File name not allowed.\r\n",  # 23
+    b"350 Ready for RNTO.\r\n",  # 24
+    b"451 Requested action aborted: local error in processing.\r\n",  # 25
+    b"226 Aborted.\r\n", # 26
+    b"426 Connection closed; transfer aborted.\r\n",  # 27
+    b"425 Can't open data connection.\r\n",  # 28
+    b"504 Command not implemented for that parameter.\r\n",  # 29
+    b"350 Ready for CPTO.\r\n",  # 30
+]
+
+_RETR = 0  # Transfer kinds
+_STOR = 1
+_LIST = 2
+
+_NLST = 3  # Listing formats, _LIST is the ls -l style one.
+_MLSD = 4
+
+_HASH = 5  # Not data transfers, reads a file through a digest for HASH,
+_COPY = 6  # or copies it on the device for SITE CPTO.
+
+_hashes = (  # HASH algorithm names and their hashlib constructors.
+    ("SHA-256", "sha256"),
+    ("SHA-1", "sha1"),
+    ("MD5", "md5"),
+    ("CRC32", None),
+)
+
+_months = (
+    b"Jan",
+    b"Feb",
+    b"Mar",
+    b"Apr",
+    b"May",
+    b"Jun",
+    b"Jul",
+    b"Aug",
+    b"Sep",
+    b"Oct",
+    b"Nov",
+    b"Dec",
+)
+
+_feats = [  # Advertised by FEAT.
+    b"MLST type*;size*;modify*;",
+    b"SIZE",
+    b"REST STREAM",
 ]
 
+_C_AUTH = 1  # Command flags, for the _cmds table.
+_C_ARG = 2  # Needs an argument.
+_C_WRITE = 4  # Modifies the filesystem, refused when ro.
+_C_ANYTIME = 8  # Allowed while a transfer is running.
+
+_EAGAIN = 11  # Same errno on lwIP and Linux.
+
+
+def _find(buf, char, start, end) -> int:
+    # buf.find(), which bytearray may lack on MicroPython.
+    try:
+        return buf.find(char, start, end)
+    except AttributeError:
+        char = char[0]
+        for i in range(start, end):
+            if buf[i] == char:
+                return i
+        return -1
+
+
+def _put(mv, at, data) -> int:
+    # Copy data to mv[at:], returning where it ends, -1 if it doesn't fit.
+    # The _put functions pass a -1 on, so they can be chained.
+    if at < 0 or at + len(data) > len(mv):
+        return -1
+    mv[at : at + len(data)] = data
+    return at + len(data)
+
+
+def _put_num(mv, at, value, width=1) -> int:
+    # value in decimal, zero padded to width, no str made for it.
+    digits = 1
+    top = 10
+    while value >= top:
+        digits += 1
+        top *= 10
+    digits = max(digits, width)
+    if at < 0 or at + digits > len(mv):
+        return -1
+    for i in range(at + digits - 1, at - 1, -1):
+        mv[i] = 48 + value % 10
+        value //= 10
+    return at + digits
+
+
+def _put_str(mv, at, text) -> int:
+    # text UTF-8 encoded, ASCII goes over a char at a time without encoding the whole.
+    for c in text:
+        if at < 0:
+            return -1
+        o = ord(c)
+        if o < 128 and at < len(mv):
+            mv[at] = o
+            at += 1
+        else:
+            at = _put(mv, at, c.encode(_enc))
+    return at
+
+
+def _put_facts(mv, at, stati, name) -> int:
+    # RFC 3659 facts for MLSD and MLST, written like _put.
+    date_sr = localtime(max(min(2145916800, stati[8]), 946684800))
+    at = _put(mv, at, b"type=file;size=" if stati[0] & 0x8000 else b"type=dir;size=")
+    at = _put(mv, _put_num(mv, at, stati[6]), b";modify=")
+    at = _put_num(mv, at, date_sr[0], 4)
+    for i in range(1, 6):
+        at = _put_num(mv, at, date_sr[i], 2)
+    return _put_str(mv, _put(mv, at, b"; "), name)
+
+
+def _would_block(err) -> bool:
+    # True if a non-blocking socket call just had nothing to do.
+    return bool(err.args) and err.args[0] == _EAGAIN
+
+
+_z = None  # What MODE Z compresses with, see _z_lib.
+
+
+def _z_lib():
+    # zlib, or deflate where zlib can't compress, False if this port has neither.
+    # Looked up once, FEAT and MODE ask on every request.
+    global _z
+    if _z is None:
+        _z = False
+        try:
+            import zlib
+
+            if hasattr(zlib, "compressobj"):
+                _z = zlib
+        except ImportError:
+            pass
+        if not _z:
+            try:
+                import deflate
+
+                _z = deflate
+            except ImportError:
+                pass
+    return _z
+
+
+def _compressor(level, wbits):
+    # A zlib stream compressor for MODE Z, None if this port has none.
+    lib = _z_lib()
+    if not lib:
+        return None
+    if hasattr(lib, "compressobj"):
+        return lib.compressobj(level, 8, wbits)
+    return _deflater(lib, wbits)
+
+
+def _decompressor():
+    # The MODE Z upload side, None if this port can't inflate incrementally.
+    try:
+        from zlib import decompressobj
+    except ImportError:
+        return None
+    return decompressobj()
+
+
+def _has_z() -> bool:
+    return bool(_z_lib())
+
+
+class _deflater(IOBase):
+    # compressobj() lookalike on deflate.DeflateIO, for MicroPython.
+    # DeflateIO writes its output into this object, compress() hands it over.
+    def __init__(self, deflate, wbits) -> None:
+        self._out = bytearray()
+        self._d = deflate.DeflateIO(self, deflate.ZLIB, wbits)
+
+    def write(self, buf) -> int:
+        self._out.extend(buf)
+        return len(buf)
+
+    def compress(self, data) -> bytes:
+        self._d.write(data)
+        return self._take()
+
+    def flush(self) -> bytes:
+        self._d.close()
+        return self._take()
+
+    def _take(self) -> bytes:
+        out = bytes(self._out)
+        self._out = bytearray()
+        return out
+
+
+class _crc:
+    # CRC32 with the hashlib interface.
+    def __init__(self) -> None:
+        self.value = 0
+
+    def update(self, data) -> None:
+        self.value = crc32(data, self.value)
+
+    def digest(self) -> bytes:
+        return self.value.to_bytes(4, "big")
+
+
+def _hasher(algo):
+    # A new digest object for a HASH algorithm name, None if this port lacks it.
+    for name, func in _hashes:
+        if name == algo:
+            if func is None:
+                return _crc()
+            try:
+                import hashlib
+
+                return getattr(hashlib, func)()
+            except (ImportError, AttributeError, ValueError):
+                return None
+    return None
+
+
+def _hash_algos() -> list:
+    return [name for name, func in _hashes if _hasher(name) is not None]
+
+
+def _tar_block(name, size, mtime, kind) -> bytearray:
+    # A single ustar header block, name already cut to fit.
+    h = bytearray(512)
+    h[: len(name)] = name
+    h[100:108] = b"0000755\0" if kind == 53 else b"0000644\0"
+    h[108:116] = b"0000000\0"
+    h[116:124] = b"0000000\0"
+    h[124:136] = b"%011o\0" % size
+    h[136:148] = b"%011o\0" % int(mtime)
+    h[148:156] = b"        "
+    h[156] = kind
+    h[257:265] = b"ustar\x0000"
+    return h
+
+
+def _tar_sum(h) -> bytearray:
+    h[148:156] = b"%06o\0 " % sum(h)
+    return h
+
+
+def _tar_header(name, size, mtime, is_dir) -> bytearray:
+    # A ustar header. Names over 100 bytes go into the prefix field,
+    # or when they don't fit there either, a pax header ahead of it carries them.
+    name = name.encode(_enc)
+    kind = 53 if is_dir else 48  # "5" or "0"
+    if len(name) <= 100:
+        return _tar_sum(_tar_block(name, size, mtime, kind))
+    cut = name.rfind(b"/", 0, 156)
+    if cut > 0 and len(name) - cut - 1 <= 100:
+        h = _tar_block(name[cut + 1 :], size, mtime, kind)
+        h[345 : 345 + cut] = name[:cut]
+        return _tar_sum(h)
+    record = b" path=" + name + b"\n"  # "<length> path=<name>\n", the length counting itself.
+    length = len(record) + len(str(len(record)))
+    length += len(str(length)) - len(str(len(record)))
+    record = str(length).encode(_enc) + record
+    h = _tar_sum(_tar_block(b"././@PaxHeader", len(record), mtime, 120))  # "x"
+    h.extend(record)
+    h.extend(bytes(-len(record) % 512))
+    h.extend(_tar_sum(_tar_block(name[:100], size, mtime, kind)))
+    return h
+
+
+def _tar_name(data) -> str:
+    # A member name, OSError if it isn't valid for us so the upload ends with a 451.
+    try:
+        return data.decode(_enc)
+    except UnicodeError:
+        raise OSError("Bad tar header!")
+
+
+class _tar_reader:
+    # Packs a directory tree into a tar stream, a readinto() at a time.
+    # Stands in for the file of a RETR, for SITE RETRTAR.
+    def __init__(self, meta, fs, root) -> None:
+        self._meta = meta
+        self._fs = fs
+        self._root = root.rstrip("/") + "/"
+        self._stack = [[self._root, meta.listdir(root), 0]]  # [path, names, index]
+        self._f = None  # Member being read.
+        self._left = 0  # Bytes of it still to go.
+        self._pad = 0  # Zeros after it.
+        self._pending = b""  # Header or trailer bytes not handed out yet.
+
+    def readinto(self, buf) -> int:
+        mv = memoryview(buf)
+        used = 0
+        while used < len(mv):
+            if self._pending:
+                size = min(len(self._pending), len(mv) - used)
+                mv[used : used + size] = self._pending[:size]
+                self._pending = self._pending[size:]
+                used += size
+            elif self._left:
+                size = min(self._left, len(mv) - used)
+                got = self._f.readinto(mv[used : used + size])
+                if not got:  # Shrank while we read it, keep the archive consistent.
+                    mv[used : used + size] = bytes(size)
+                    got = size
+                self._left -= got
+                used += got
+            elif self._f is not None:
+                self._f.close()
+                self._f = None
+                self._pending = memoryview(bytes(self._pad))
+            elif self._stack is not None:
+                self._next()
+            else:
+                break
+        return used
+
+    def _next(self) -> None:
+        # Queue the header of the next member, or the end of archive.
+        # A member that can't be read raises OSError, failing the transfer rather than leaving it out.
+        while self._stack:
+            entry = self._stack[-1]
+            if entry[2] == len(entry[1]):
+                self._stack.pop()
+                continue
+            name = entry[1][entry[2]]
+            entry[2] += 1
+            path = entry[0] + name
+            try:
+                stati = self._meta.stat(path)
+            except OSError:
+                continue  # Deleted since it was listed.
+            if stati[0] & 0x4000:
+                self._stack.append([path + "/", self._meta.listdir(path), 0])
+                self._pending = memoryview(
+                    _tar_header(path[len(self._root) :] + "/", 0, stati[8], True)
+                )
+            else:
+                self._f = self._fs.open(path, "rb")
+                self._left = stati[6]
+                self._pad = -stati[6] % 512
+                self._pending = memoryview(
+                    _tar_header(path[len(self._root) :], stati[6], stati[8], False)
+                )
+            return
+        self._stack = None
+        self._pending = memoryview(bytes(1024))  # End of archive.
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        self._stack = None
+
+
+class _tar_writer:
+    # Unpacks a tar stream into a directory as it arrives.
+    # Stands in for the file of a STOR, for SITE STORTAR.
+    def __init__(self, fs, root) -> None:
+        self._fs = fs
+        self._root = root.rstrip("/") + "/"
+        self._head = bytearray(512)
+        self._fill = 0  # Header bytes received.
+        self._f = None  # Member being written, None to skip it.
+        self._left = 0  # Its bytes still to come.
+        self._skip = 0  # Padding after it.
+        self._meta = None  # GNU long name or pax header being received.
+        self._name = None  # Name from it, for the next member.
+        self._kind = 0  # Which of the two.
+        self._done = False
+        self.files = 0  # Members unpacked.
+
+    def write(self, buf) -> int:
+        mv = memoryview(buf)
+        i = 0
+        while i < len(mv) and not self._done:
+            if self._left:
+                size = min(self._left, len(mv) - i)
+                if self._f is not None:
+                    self._f.write(mv[i : i + size])
+                elif self._meta is not None:
+                    self._meta.extend(mv[i : i + size])
+                self._left -= size
+                i += size
+                if not self._left and self._f is not None:
+                    self._f.close()
+                    self._f = None
+                elif not self._left and self._meta is not None:
+                    self._long_name()
+            elif self._skip:
+                size = min(self._skip, len(mv) - i)
+                self._skip -= size
+                i += size
+            else:
+                size = min(512 - self._fill, len(mv) - i)
+                self._head[self._fill : self._fill + size] = mv[i : i + size]
+                self._fill += size
+                i += size
+                if self._fill == 512:
+                    self._fill = 0
+                    self._member()
+        return len(buf)
+
+    def _field(self, start, end) -> bytes:
+        field = bytes(self._head[start:end])
+        cut = field.find(b"\0")
+        return field if cut < 0 else field[:cut]
+
+    def _member(self) -> None:
+        # A full header arrived, set up for its data.
+        h = self._head
+        if not any(h):
+            self._done = True  # End of archive.
+            return
+        try:
+            check = int(self._field(148, 156).strip() or b"0", 8)
+            size = int(self._field(124, 136).strip() or b"0", 8)
+        except ValueError:
+            raise OSError("Bad tar header!")
+        h[148:156] = b"        "
+        if sum(h) != check:
+            raise OSError("Bad tar header!")
+        name = _tar_name(self._field(0, 100))
+        if h[257:262] == b"ustar" and h[345]:
+            name = _tar_name(self._field(345, 500)) + "/" + name
+        if self._name is not None:
+            name = self._name
+            self._name = None
+        kind = h[156]
+        self._left = size
+        self._skip = -size % 512
+        if kind in (76, 120) and size <= 4096:  # "L" GNU long name, "x" pax header.
+            self._meta = bytearray()
+            self._kind = kind
+            if not size:
+                self._long_name()
+            return
+        parts = [i for i in name.split("/") if i and i != "."]
+        if not parts or ".." in parts:
+            return  # Skipped, never write outside the root.
+        path = self._root + "/".join(parts)
+        if kind == 53:  # "5", directory
+            self._mkdirs(path)
+        elif kind in (0, 48, 55):  # "0", "\0" and "7", regular files
+            try:
+                self._f = self._fs.open(path, "wb")
+            except OSError:
+                self._mkdirs(path[: path.rfind("/")])
+                self._f = self._fs.open(path, "wb")
+            self.files += 1
+            if not size:
+                self._f.close()
+                self._f = None
+        # Anything else, links and pax headers, gets skipped.
+
+    def _long_name(self) -> None:
+        # The name a GNU long name or pax header holds for the next member.
+        data = bytes(self._meta)
+        self._meta = None
+        if self._kind == 76:
+            cut = data.find(b"\0")
+            self._name = _tar_name(data if cut < 0 else data[:cut])
+            return
+        for record in data.split(b"\n"):  # "<length> <key>=<value>"
+            record = record.split(b" ", 1)[-1]
+            if record.startswith(b"path="):
+                self._name = _tar_name(record[5:])
+
+    def _mkdirs(self, path) -> None:
+        parts = path[len(self._root) :].split("/")
+        for i in range(len(parts)):
+            try:
+                self._fs.mkdir(self._root + "/".join(parts[: i + 1]))
+            except OSError:  # Exists already.
+                pass
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+class _transfer:
+    # A file transfer in progress, moved a chunk at a time by poll().
+    def __init__(self, kind, f) -> None:
+        self.kind = kind
+        self.f = f
+        self.path = None  # STOR: the file, to drop from the meta cache once written.
+        self.buf = b""  # RETR: chunk being sent.
+        self.sent = 0  # RETR: how much of buf already went out.
+        self.block = None  # RETR: the send buffer, leased from the buffer pool.
+        self.fill = 0  # STOR: bytes waiting in the bank being received into.
+        self.bank = 0  # STOR: which half of the file cache is receiving.
+        self.ready = 0  # STOR: bytes in the other bank, waiting to be written.
+        self.pos = 0  # STOR: file offset the next write lands at.
+        self.start = monotonic()  # For the data connection timeout.
+        self.begin = None  # When the data connection was up.
+        self.moved = 0  # Payload bytes so far.
+        self.fmt = _LIST  # LIST: listing format.
+        self.target = None  # LIST: directory being listed, with a trailing slash.
+        self.items = None  # LIST: its entries.
+        self.listing = None  # LIST: the meta cache listing, which keeps the entries' stats.
+        self.index = 0  # LIST: next entry to format.
+        self.z = None  # MODE Z: the compressor, or decompressor for STOR.
+        self.h = None  # HASH and STOR: the running digest.
+        self.algo = None  # HASH and STOR: its algorithm name.
+        self.x = False  # HASH: reply XCRC/XSHA256 style.
+        self.stati = None  # HASH: the file's stat when reading began, the digest cache key.
+        self.src = None  # COPY: the file being copied, f is the copy.
+        self.ascii = False  # TYPE A: translate line endings.
+        self.cr = False  # TYPE A: the last chunk ended in a CR.
+
+
+class buffer_pool:
+    """
+    Hands out the server's buffers from a fixed RAM budget, so its footprint
+    has a known ceiling. Returned buffers are kept for reuse, and dropped
+    when something of another size needs the room.
+
+    Leases are plain bytearrays, take memoryviews of them as needed.
+    used counts everything the pool holds, peak is the most it ever held.
+    """
+
+    def __init__(self, budget=None, keep=8) -> None:
+        self.budget = budget  # None for no limit.
+        self.keep = keep  # Free buffers kept around at most.
+        self.used = 0
+        self.leased = 0
+        self.peak = 0
+        self.denied = 0  # Leases refused for the budget.
+        self._free = []
+
+    def lease(self, size):
+        # A buffer of exactly size bytes, None if it doesn't fit in the budget.
+        for i in range(len(self._free)):
+            if len(self._free[i]) == size:
+                self.leased += size
+                return self._free.pop(i)
+        if self.budget is not None:
+            while self._free and self.used + size > self.budget:
+                self.used -= len(self._free.pop(0))
+            if self.used + size > self.budget:
+                self.denied += 1
+                return None
+        self.used += size
+        self.leased += size
+        if self.used > self.peak:
+            self.peak = self.used
+        return bytearray(size)
+
+    def release(self, buf) -> None:
+        self.leased -= len(buf)
+        self._free.append(buf)
+        if len(self._free) > self.keep:
+            self.used -= len(self._free.pop(0))
+
+    def trim(self) -> None:
+        # Let go of the free buffers.
+        for i in self._free:
+            self.used -= len(i)
+        self._free = []
+
+
+class gc_policy:
+    """
+    Decides when the server runs the garbage collector.
+
+    mode can be:
+      "aggressive": Collect at every chance, after each command and file chunk.
+      "threshold": Collect when free memory drops under min_free bytes,
+        or once alloc_limit bytes were allocated since the last collection.
+      "idle": Like "threshold", but while a transfer runs only collect
+        if under min_free, so transfers don't stall on the collector.
+    """
+
+    def __init__(self, mode="threshold", min_free=16384, alloc_limit=32768) -> None:
+        if mode not in ("aggressive", "threshold", "idle"):
+            raise ValueError("Unknown gc mode!")
+        self.mode = mode
+        self.min_free = min_free
+        self.alloc_limit = alloc_limit
+        self.collections = 0
+        self.collect_time = 0  # Seconds spent collecting.
+        self._noted = 0  # Allocations reported with note(), where mem_alloc is missing.
+        self._base = mem_alloc() if mem_alloc is not None else 0
+
+    def note(self, size) -> None:
+        # Report an allocation of about size bytes.
+        self._noted += size
+
+    def point(self, transfer=False) -> bool:
+        # A point where collecting is safe. Returns True if it collected.
+        if self.mode != "aggressive":
+            low = mem_free is not None and mem_free() < self.min_free
+            if not low:
+                if transfer and self.mode == "idle":
+                    return False
+                if mem_alloc is not None:
+                    allocated = mem_alloc() - self._base
+                else:
+                    allocated = self._noted
+                if allocated < self.alloc_limit:
+                    return False
+        start = monotonic_ns()
+        collect()
+        self.collect_time += (monotonic_ns() - start) / 1000000000
+        self.collections += 1
+        self._noted = 0
+        if mem_alloc is not None:
+            self._base = mem_alloc()
+        return True
+
+
+class flash_fs:
+    """
+    The default filesystem backend, the board's own filesystem through os.
+
+    A backend is anything with these methods, see ram_fs for another one.
+    Paths are always absolute and "/" separated.
+    Errors are raised as OSError, like os does.
+    """
+
+    def open(self, path, mode):
+        return open(path, mode)
+
+    def stat(self, path) -> tuple:
+        return stat(path)
+
+    def listdir(self, path) -> list:
+        return listdir(path)
+
+    def remove(self, path) -> None:
+        remove(path)
+
+    def mkdir(self, path) -> None:
+        mkdir(path)
+
+    def rmdir(self, path) -> None:
+        rmdir(path)
+
+    def rename(self, src, dst) -> None:
+        rename(src, dst)
+
+    def __init__(self) -> None:
+        self._rw = False  # Remounted writable by us.
+
+    def remount(self, writable, path=None) -> None:
+        # Called before and after the server writes, with the write window batched.
+        # path is what's about to be written, None for anything. It's all one drive here.
+        if remount is not None and writable != self._rw:
+            self._rw = False
+            remount("/", not writable)
+        self._rw = writable
+
+
+class _ram_file:
+    # An open file of a ram_fs, what open() returns.
+    def __init__(self, fs, entry, mode) -> None:
+        self._fs = fs
+        self._entry = entry  # [data, mtime]
+        self._text = "b" not in mode
+        self._append = mode[0] == "a"
+        self.pos = 0
+        if mode[0] == "w":
+            self._fs.used -= len(entry[0])
+            entry[0] = bytearray()
+        elif self._append:
+            self.pos = len(entry[0])
+
+    def read(self, size=-1):
+        data = self._entry[0]
+        end = len(data) if size < 0 else min(len(data), self.pos + size)
+        res = bytes(data[self.pos : end])
+        self.pos = max(self.pos, end)
+        return res.decode(_enc) if self._text else res
+
+    def readinto(self, buf) -> int:
+        data = self._entry[0]
+        size = max(0, min(len(buf), len(data) - self.pos))
+        buf[:size] = memoryview(data)[self.pos : self.pos + size]
+        self.pos += size
+        return size
+
+    def write(self, buf) -> int:
+        if isinstance(buf, str):
+            buf = buf.encode(_enc)
+        data = self._entry[0]
+        if self._append:
+            self.pos = len(data)
+        size = len(buf)
+        grow = max(0, self.pos + size - len(data))
+        if self._fs.max_bytes is not None and self._fs.used + grow > self._fs.max_bytes:
+            raise OSError(28)  # ENOSPC
+        if self.pos > len(data):  # Seeked past the end, fill the hole.
+            data.extend(bytes(self.pos - len(data)))
+        data[self.pos : self.pos + size] = buf
+        self._fs.used += grow
+        self.pos += size
+        self._entry[1] = time()
+        return size
+
+    def seek(self, pos, whence=0) -> int:
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += len(self._entry[0])
+        self.pos = max(0, pos)
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self._entry = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class ram_fs:
+    """
+    A filesystem backend kept in RAM, for data that shouldn't wear the flash,
+    like sensor captures and logs. It is gone on reset.
+
+    max_bytes limits the total size of the files, None for no limit.
+    Your own code can use open() and the rest of the methods just like
+    the server does. Use mount_fs to serve it next to the flash.
+    """
+
+    def __init__(self, max_bytes=None) -> None:
+        self.max_bytes = max_bytes
+        self.used = 0  # Bytes held by files.
+        self._root = [{}, time()]  # Directories are [{name: entry}, mtime]
+
+    def _find(self, path):
+        # The entry at path.
+        entry = self._root
+        for name in path.split("/"):
+            if not name:
+                continue
+            if not isinstance(entry[0], dict):
+                raise OSError(20)  # ENOTDIR
+            entry = entry[0].get(name)
+            if entry is None:
+                raise OSError(2)  # ENOENT
+        return entry
+
+    def _parent(self, path):
+        # The directory holding path, and the name in it.
+        path = path.rstrip("/")
+        cut = path.rfind("/")
+        parent = self._find(path[:cut])
+        if not isinstance(parent[0], dict) or not path[cut + 1 :]:
+            raise OSError(2)  # ENOENT
+        return parent, path[cut + 1 :]
+
+    def open(self, path, mode):
+        parent, name = self._parent(path)
+        entry = parent[0].get(name)
+        if entry is None:
+            if mode[0] == "r":
+                raise OSError(2)  # ENOENT
+            entry = [bytearray(), time()]
+            parent[0][name] = entry
+            parent[1] = entry[1]
+        elif isinstance(entry[0], dict):
+            raise OSError(21)  # EISDIR
+        return _ram_file(self, entry, mode)
+
+    def stat(self, path) -> tuple:
+        entry = self._find(path)
+        if isinstance(entry[0], dict):
+            return (0x4000, 0, 0, 0, 0, 0, 0, entry[1], entry[1], entry[1])
+        return (0x8000, 0, 0, 0, 0, 0, len(entry[0]), entry[1], entry[1], entry[1])
+
+    def listdir(self, path) -> list:
+        entry = self._find(path)
+        if not isinstance(entry[0], dict):
+            raise OSError(20)  # ENOTDIR
+        return list(entry[0])
+
+    def remove(self, path) -> None:
+        parent, name = self._parent(path)
+        entry = parent[0].get(name)
+        if entry is None:
+            raise OSError(2)  # ENOENT
+        if isinstance(entry[0], dict):
+            raise OSError(21)  # EISDIR
+        self.used -= len(entry[0])
+        del parent[0][name]
+        parent[1] = time()
+
+    def mkdir(self, path) -> None:
+        parent, name = self._parent(path)
+        if name in parent[0]:
+            raise OSError(17)  # EEXIST
+        parent[1] = time()
+        parent[0][name] = [{}, parent[1]]
+
+    def rmdir(self, path) -> None:
+        parent, name = self._parent(path)
+        entry = parent[0].get(name)
+        if entry is None:
+            raise OSError(2)  # ENOENT
+        if not isinstance(entry[0], dict):
+            raise OSError(20)  # ENOTDIR
+        if entry[0]:
+            raise OSError(39)  # ENOTEMPTY
+        del parent[0][name]
+        parent[1] = time()
+
+    def rename(self, src, dst) -> None:
+        parent, name = self._parent(src)
+        entry = parent[0].get(name)
+        if entry is None:
+            raise OSError(2)  # ENOENT
+        new_parent, new_name = self._parent(dst)
+        if new_name in new_parent[0]:
+            raise OSError(17)  # EEXIST
+        if isinstance(entry[0], dict) and (dst + "/").startswith(src.rstrip("/") + "/"):
+            raise OSError(22)  # EINVAL, into itself.
+        del parent[0][name]
+        new_parent[0][new_name] = entry
+        parent[1] = new_parent[1] = time()
+
+    def remount(self, writable, path=None) -> None:
+        pass
+
+
+class mount_fs:
+    """
+    Serves several backends as one tree, picking by the longest matching prefix.
+    For example mount_fs({"/": flash_fs(), "/ram": ram_fs()})
+    Moving things between backends isn't supported, RNTO fails for those.
+    """
+
+    def __init__(self, mounts) -> None:
+        self.mounts = {}
+        for point, backend in mounts.items():
+            self.mounts[point.rstrip("/") or "/"] = backend
+
+    def _find(self, path):
+        # The backend holding path, and the path inside it.
+        best = None
+        for point in self.mounts:
+            if (
+                point == "/"
+                or path == point
+                or path.startswith(point + "/")
+            ) and (best is None or len(point) > len(best)):
+                best = point
+        if best is None:
+            raise OSError(2)  # ENOENT
+        return self.mounts[best], (path[len(best) :] if best != "/" else path) or "/"
+
+    def open(self, path, mode):
+        backend, path = self._find(path)
+        return backend.open(path, mode)
+
+    def stat(self, path) -> tuple:
+        backend, path = self._find(path)
+        return backend.stat(path)
+
+    def listdir(self, path) -> list:
+        backend, inner = self._find(path)
+        res = backend.listdir(inner)
+        base = path.rstrip("/") + "/"
+        for point in self.mounts:
+            if point != "/" and point.startswith(base):
+                name = point[len(base) :]
+                if "/" not in name and name not in res:
+                    res.append(name)
+        return res
+
+    def remove(self, path) -> None:
+        backend, path = self._find(path)
+        backend.remove(path)
+
+    def mkdir(self, path) -> None:
+        backend, path = self._find(path)
+        backend.mkdir(path)
+
+    def rmdir(self, path) -> None:
+        backend, path = self._find(path)
+        backend.rmdir(path)
+
+    def rename(self, src, dst) -> None:
+        backend, src = self._find(src)
+        other, dst = self._find(dst)
+        if other is not backend:
+            raise OSError(18)  # EXDEV
+        backend.rename(src, dst)
+
+    def remount(self, writable, path=None) -> None:
+        # Only the backend holding path goes writable, so writes to ram don't remount the flash.
+        # All of them go back read-only.
+        if writable and path is not None:
+            backend, path = self._find(path)
+            backend.remount(True, path)
+            return
+        for i in self.mounts.values():
+            i.remount(writable)
+
+
+class meta_cache:
+    """
+    A small LRU cache of stat() results and directory listings,
+    so that clients asking for the same things over and over don't hit the flash.
+
+    The stats of a listing's entries are kept with the listing, not one entry each,
+    so listing a big directory doesn't push everything else out.
+    The default fits a listing of about 200 entries with their stats.
+
+    The server drops entries itself whenever it changes the filesystem.
+    Files your own code writes are picked up once their entries are ttl seconds old,
+    or call clear() after writing. Set ttl to None if nothing else writes.
+    """
+
+    def __init__(self, max_bytes=16384, ttl=5) -> None:
+        self.max_bytes = max_bytes  # Rough RAM budget for the entries.
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.used = 0  # Estimated bytes held.
+        self.fs = None  # The filesystem backend, set by the server.
+        self._entries = OrderedDict()  # (kind, path): (value, size, time)
+
+    def stat(self, path) -> tuple:
+        res = self._get(("s", path))
+        if res is None:
+            res = self.fs.stat(path)
+            self._put(("s", path), res, 80 + len(path))
+        return res
+
+    def listdir(self, path) -> list:
+        return self.listing(path)[0]
+
+    def listing(self, path) -> list:
+        # listdir(), as [names, a stat slot per name, path], see entry().
+        # The slots are None if the stats of all entries wouldn't fit.
+        res = self._get(("l", path))
+        if res is None:
+            names = self.fs.listdir(path)
+            size = 32 + len(path)
+            for i in names:
+                size += 24 + len(i)
+            fits = size + 64 * len(names) <= self.max_bytes
+            res = [names, [None] * len(names) if fits else None, path]
+            self._put(("l", path), res, size)
+        return res
+
+    def entry(self, listing, index) -> tuple:
+        # The stat of a listing's entry, stored in the listing.
+        stats = listing[1]
+        if stats is not None and stats[index] is not None:
+            self.hits += 1
+            return stats[index]
+        self.misses += 1
+        res = self.fs.stat(listing[2].rstrip("/") + "/" + listing[0][index])
+        key = ("l", listing[2])
+        held = self._entries.get(key)
+        if stats is not None and held is not None and held[0] is listing:
+            while self.used + 64 > self.max_bytes:
+                old = next(iter(self._entries))
+                if old == key:
+                    return res  # Everything else is gone already.
+                self.used -= self._entries.pop(old)[1]
+            stats[index] = res
+            self._entries[key] = (listing, held[1] + 64, held[2])
+            self.used += 64
+        return res
+
+    def invalidate(self, path) -> None:
+        # Forget path, and the listing of the directory holding it.
+        parent = path[: path.rfind("/")] or "/"
+        for i in (("s", path), ("l", path), ("s", parent), ("l", parent)):
+            if i in self._entries:
+                self.used -= self._entries.pop(i)[1]
+
+    def clear(self) -> None:
+        self._entries = OrderedDict()
+        self.used = 0
+
+    def _get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None or (
+            self.ttl is not None and monotonic() - entry[2] > self.ttl
+        ):
+            if entry is not None:
+                self.used -= entry[1]
+            self.misses += 1
+            return None
+        self._entries[key] = entry  # Back to the young end.
+        self.hits += 1
+        return entry[0]
+
+    def _put(self, key, value, size) -> None:
+        if size > self.max_bytes:
+            return
+        while self.used + size > self.max_bytes:
+            self.used -= self._entries.pop(next(iter(self._entries)))[1]
+        self._entries[key] = (value, size, monotonic())
+        self.used += size
+
+
+class content_cache:
+    """
+    An LRU cache of whole small files, so RETRs of the same config or status
+    file get served from RAM without touching the flash.
+
+    Entries are checked against the file's size and mtime on every hit.
+    max_bytes is a hard cap on what the cache holds, 0 turns it off.
+    Only files up to max_file bytes get cached, and nothing gets added
+    while free memory is under min_free.
+    """
+
+    def __init__(self, max_bytes=0, max_file=2048, min_free=16384) -> None:
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.min_free = min_free
+        self.hits = 0
+        self.misses = 0
+        self.used = 0  # Bytes held.
+        self._entries = OrderedDict()  # path: (data, size, mtime)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def wants(self, stati) -> bool:
+        # Whether a file with this stat() should be cached.
+        return (
+            stati[6] <= self.max_file
+            and stati[6] < self.max_bytes
+            and (mem_free is None or mem_free() >= self.min_free)
+        )
+
+    def get(self, path, stati):
+        # The contents of path if cached and unchanged, otherwise None.
+        entry = self._entries.pop(path, None)
+        if entry is None or entry[1] != stati[6] or entry[2] != stati[8]:
+            if entry is not None:
+                self.used -= len(entry[0])
+            self.misses += 1
+            return None
+        self._entries[path] = entry  # Back to the young end.
+        self.hits += 1
+        return entry[0]
+
+    def put(self, path, stati, data) -> None:
+        if len(data) > self.max_bytes:
+            return
+        self.invalidate(path)
+        while self.used + len(data) > self.max_bytes:
+            self.used -= len(self._entries.pop(next(iter(self._entries)))[0])
+        self._entries[path] = (data, stati[6], stati[8])
+        self.used += len(data)
+
+    def invalidate(self, path) -> None:
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self.used -= len(entry[0])
+
+    def clear(self) -> None:
+        self._entries = OrderedDict()
+        self.used = 0
+
+
+class digest_cache:
+    """
+    Remembers file digests, so checking an unchanged file again is free.
+    Entries are checked against the file's size and mtime.
+    Uploads get their digest computed on the way in, see ftp.stor_hash.
+    """
+
+    def __init__(self, max_entries=32) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # path: (size, mtime, {algo: digest})
+
+    def get(self, path, stati, algo):
+        entry = self._entries.pop(path, None)
+        if entry is not None and entry[0] == stati[6] and entry[1] == stati[8]:
+            self._entries[path] = entry  # Back to the young end.
+            if algo in entry[2]:
+                self.hits += 1
+                return entry[2][algo]
+        self.misses += 1
+        return None
+
+    def put(self, path, stati, algo, digest) -> None:
+        if not self.max_entries:
+            return
+        entry = self._entries.pop(path, None)
+        if entry is None or entry[0] != stati[6] or entry[1] != stati[8]:
+            entry = (stati[6], stati[8], {})
+        entry[2][algo] = digest
+        while len(self._entries) >= self.max_entries:
+            self._entries.pop(next(iter(self._entries)))
+        self._entries[path] = entry
+
+    def invalidate(self, path) -> None:
+        self._entries.pop(path, None)
+
+    def clear(self) -> None:
+        self._entries = OrderedDict()
+
+
+class metrics:
+    """
+    Counters for finding out where the time goes on a running server.
+    Times are in seconds, rates in bytes per second.
+    ftp.stats() adds gc and buffer figures, SITE STATS sends the lot to the client.
+    """
+
+    bounds = (1, 5, 20, 100, 500)  # Latency histogram bucket edges, in ms.
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.bytes_tx = 0  # Data connection payload.
+        self.bytes_rx = 0
+        self.tx_time = 0  # Time spent in downloads and listings.
+        self.rx_time = 0  # Time spent in uploads.
+        self.last_tx_rate = 0
+        self.last_rx_rate = 0
+        self.transfers = 0
+        self.aborted = 0  # Transfers that didn't end with a 226.
+        self.pasv_setups = 0
+        self.pasv_time = 0  # From the transfer command till the client connected.
+        self.kicked = 0  # Turned away, no free session.
+        self.timeouts = 0  # Auth timeouts.
+        self.data_timeouts = 0  # Clients that never opened the data connection.
+        self.commands = {}  # verb: [count, total time, histogram]
+
+    @property
+    def tx_rate(self) -> float:
+        return self.bytes_tx / self.tx_time if self.tx_time else 0
+
+    @property
+    def rx_rate(self) -> float:
+        return self.bytes_rx / self.rx_time if self.rx_time else 0
+
+    def command(self, verb, took) -> None:
+        # Record a command that took `took` nanoseconds.
+        entry = self.commands.get(verb)
+        if entry is None:
+            entry = [0, 0, [0] * (len(self.bounds) + 1)]
+            self.commands[verb] = entry
+        entry[0] += 1
+        entry[1] += took / 1000000000
+        took //= 1000000
+        for i in range(len(self.bounds)):
+            if took < self.bounds[i]:
+                entry[2][i] += 1
+                return
+        entry[2][-1] += 1
+
+    def transfer(self, sending, size, took, ok) -> None:
+        self.transfers += 1
+        if not ok:
+            self.aborted += 1
+        if sending:
+            self.bytes_tx += size
+            self.tx_time += took
+            if took:
+                self.last_tx_rate = size / took
+        else:
+            self.bytes_rx += size
+            self.rx_time += took
+            if took:
+                self.last_rx_rate = size / took
+
+
+class bandwidth:
+    """
+    Token bucket rate limits for the data connections, in bytes per second.
+    total caps both directions together, tx downloads and listings, rx uploads.
+    None leaves that one unlimited. All of them can be changed at any time.
+
+    Set idle while the host has no time critical traffic of its own,
+    the limits are multiplied by idle_boost meanwhile, None lifting them.
+    """
+
+    def __init__(self, total=None, tx=None, rx=None, idle_boost=1, burst=0.25) -> None:
+        self.total = total
+        self.tx = tx
+        self.rx = rx
+        self.idle_boost = idle_boost
+        self.burst = burst  # Seconds worth of data a bucket saves up.
+        self.idle = False
+        self.held = 0  # Chunks held back, waiting for tokens.
+        self._tokens = [0, 0, 0]  # total, tx, rx
+        self._need = 512  # The chunk held back last.
+        self._holding = [False, False]  # A chunk is being held back, rx and tx.
+        self._last = monotonic_ns()
+
+    def _rate(self, i):
+        # The limit in effect for a bucket, None if there's none.
+        rate = (self.total, self.tx, self.rx)[i]
+        if rate and self.idle:
+            rate = None if self.idle_boost is None else rate * self.idle_boost
+        return rate or None
+
+    def _refill(self) -> None:
+        now = monotonic_ns()
+        secs = (now - self._last) / 1000000000
+        self._last = now
+        for i in range(3):
+            rate = self._rate(i)
+            if rate:
+                self._tokens[i] = min(self._tokens[i] + rate * secs, self._size(rate))
+
+    def _size(self, rate) -> int:
+        # How many tokens a bucket holds at most.
+        return max(int(rate * self.burst), 512)
+
+    def allow(self, sending, want) -> int:
+        # How many of want bytes may move now, 0 to hold off.
+        # Waits for a whole chunk worth, or a full bucket if that's smaller.
+        if self._rate(0) is None and self._rate(1 if sending else 2) is None:
+            return want
+        self._refill()
+        for i in (0, 1 if sending else 2):
+            rate = self._rate(i)
+            if rate and self._tokens[i] < min(want, self._size(rate)):
+                self._need = want
+                self._hold(sending)
+                return 0
+        self._holding[sending] = False
+        size = want
+        for i in (0, 1 if sending else 2):
+            if self._rate(i):
+                size = min(size, int(self._tokens[i]))
+        return size
+
+    def _hold(self, sending) -> None:
+        # Count a held back chunk once, not on every poll or wait it spends waiting.
+        if not self._holding[sending]:
+            self._holding[sending] = True
+            self.held += 1
+
+    def take(self, sending, size) -> None:
+        # Spend the tokens of size bytes that went through.
+        for i in (0, 1 if sending else 2):
+            if self._rate(i):
+                self._tokens[i] -= size
+
+    def delay(self, sending) -> float:
+        # Seconds till a chunk may move in that direction, 0 if right away.
+        if self._rate(0) is None and self._rate(1 if sending else 2) is None:
+            return 0
+        self._refill()
+        res = 0
+        for i in (0, 1 if sending else 2):
+            rate = self._rate(i)
+            if rate:
+                res = max(res, (min(self._need, self._size(rate)) - self._tokens[i]) / rate)
+        if res > 0:
+            self._hold(sending)
+        return res
+
+
+class session:
+    """
+    The state of a single control connection.
+    Everything a client can change with a command lives here, so that several
+    clients can be served by the same ftp object.
+    """
+
+    def __init__(self, conn, client, slot, authenticated, mode) -> None:
+        self.conn = conn
+        self.client = client
+        self.slot = slot  # Index in the session table.
+        self.cwd = "/"
+        self.authenticated = authenticated
+        self.user = None
+        self.mode = mode  # False == "I", True = "A"
+        self.zmode = False  # MODE Z
+        self.hash = "SHA-256"  # Algorithm for HASH, set with OPTS HASH.
+        self.rename_from = None
+        self.copy_from = None  # Set by SITE CPFR.
+        self.rest = 0  # Offset set by REST for the next RETR/STOR.
+        self.pasv = False
+        self.pasv_sock = None
+        self.pasv_port = None
+        self.data_socket = None
+        self.data_ip = None
+        self.data_port = None
+        self.timer = monotonic()
+        self.pollt = monotonic()
+        self.rx = b""  # Start of a command line still being received.
+        self.queue = []  # Commands received but not yet run.
+        self.out = b""  # Replies the socket didn't take yet.
+        self.xfer = None  # The running transfer, if any.
+
 
 class ftp:
     def __init__(
@@ -47,11 +1364,24 @@ class ftp:
         maxbuf=2880,
         auth_timeout=120,
         verbose=False,
+        max_sessions=1,
+        block_size=512,
+        gc=None,
+        meta=None,
+        write_idle=1,
+        fs=None,
+        content=None,
+        ram_budget=None,
     ) -> None:
         # Public
-        self.pasv_port = 20  # This port will be used for pasv connections.
-        self.data_ip = None
-        self.data_port = None
+        self.pasv_port = 20
+        """
+        This port will be used for pasv connections.
+        Each session keeps its own listener, on the lowest free one of pasv_range
+        ports from pasv_port up, the control port never being one of them.
+        With a single session that is always pasv_port itself.
+        """
+        self.pasv_range = max_sessions
         if auth_timeout < 0:
             raise ValueError("auth_timeout must be at least 0!")
         self.auth_timeout = auth_timeout
@@ -68,8 +1398,76 @@ class ftp:
         self._max_cache = (
             maxcache  # How many times maxbuf do we store before actually writing.
         )
-        self.mode = False  # False == "I", True = "A"
+        if max_sessions < 1:
+            raise ValueError("max_sessions must be at least 1!")
+        if block_size < 1:
+            raise ValueError("block_size must be at least 1!")
+        if ram_budget is not None and ram_budget < (maxcache + 1) * maxbuf:
+            raise ValueError("ram_budget can't fit the file cache and rx buffer!")
+        self.block_size = block_size
+        """
+        The filesystem block size. Uploads are written in whole blocks,
+        so use your FAT cluster size (512 or 4096 usually).
+        The file cache is split in two, each half should fit at least one block.
+        """
+        self.mode = False  # Transfer mode new sessions start in. False == "I", True = "A"
         self.ro = False  # Set to True to reject writes.
+        self.z_level = 6
+        """
+        MODE Z compression level, 1 is the fastest, 9 the smallest.
+        Ignored on MicroPython's deflate module.
+        """
+        self.z_wbits = 10
+        """
+        MODE Z compression window, 2 ** z_wbits bytes. 9 to 15.
+        Bigger compresses better, but costs RAM for every download.
+        """
+        self.write_idle = write_idle
+        """
+        Seconds the filesystem stays writable after the last modifying command,
+        so a burst of uploads pays for a single pair of remounts.
+        0 remounts read-only after every command.
+        """
+        self.gc = gc if gc is not None else gc_policy()
+        """
+        When to run the garbage collector, see gc_policy.
+        Can be swapped at runtime.
+        """
+        self.meta = meta if meta is not None else meta_cache()
+        """
+        The stat() and listdir() cache, see meta_cache.
+        Pass meta_cache(max_bytes=0) to turn caching off.
+        """
+        self.content = content if content is not None else content_cache()
+        """
+        The file contents cache for RETR, see content_cache.
+        Off by default, pass content_cache(max_bytes=8192) or so to use it.
+        """
+        self.digests = digest_cache()
+        """
+        Digests for HASH, XCRC and XSHA256, see digest_cache.
+        """
+        self.stor_hash = True
+        """
+        Digest uploads as they come in, with the session's HASH algorithm,
+        so that checking them afterwards doesn't read them back.
+        """
+        self.buffers = buffer_pool(ram_budget)
+        """
+        Where the receive buffer, file cache and send buffers come from, see buffer_pool.
+        ram_budget caps it, None for no limit. Transfers that don't fit get a 451.
+        """
+        self.fs = fs if fs is not None else flash_fs()
+        self.metrics = metrics()
+        """
+        Transfer, command latency and connection counters, see metrics.
+        Call self.metrics.reset() to start counting over.
+        """
+        self.bandwidth = bandwidth()
+        """
+        Rate limits for RETR, STOR and listings, see bandwidth.
+        Unlimited by default, set self.bandwidth.tx = 32768 and so on at any time.
+        """
 
         # Private
         self._pool = pool
@@ -79,24 +1477,23 @@ class ftp:
         except AttributeError:
             pass
         self._socket.setblocking(False)
-        self._data_socket = None
         self._socket.bind((ip, port))
-        self._socket.listen(2)
+        self._socket.listen(max_sessions + 1)
         self._iptup = (ip, port)
-        self._conn = None
-        self._client = None
-        self._client_pasv = None
-        self._rx_buf = bytearray(maxbuf)
+        self._sessions = [None] * max_sessions
+        self._cur = None  # The session last serviced.
+        self._next = 0  # Round robin start point.
+        self._rx_buf = self.buffers.lease(maxbuf)
         self._maxbuf = maxbuf
-        self._authenticated = not bool(len(authlist))
-        self._pasv = False
-        self._pasv_sock = None
-        self._pollt = monotonic()
         self._authlist = authlist
-        self._tmpuser = None
-        self._timer = None
-        self._file_cache = bytearray(maxcache * maxbuf)
-        self._rename_from = None
+        self._file_cache = self.buffers.lease(maxcache * maxbuf)
+        self._cache_owner = None  # Only one upload can use the file cache.
+        self._writers = 0  # Operations currently needing a writable filesystem.
+        self._rw = False  # Mounted writable.
+        self._rw_idle = monotonic()  # When the last writer finished.
+        self._held = False  # The host holds a write window, see begin_write().
+        self._done = 0  # Commands run and chunks moved, tells poll(budget_ms) when to stop.
+        self._deadline = None  # monotonic_ns() past which a budgeted poll() stops.
 
     @property
     def max_cache(self) -> int:
@@ -110,80 +1507,219 @@ class ftp:
     def max_cache(self, value) -> None:
         if value < 2:
             raise ValueError("Cache must be at least 2 times the buffer!")
+        old = self._max_cache
         self._max_cache = value
-        self._reset_file_cache()
+        if self._cache_owner is None:  # Otherwise once the upload is done.
+            if not self._resize_cache():
+                self._max_cache = old
+                raise ValueError("Cache doesn't fit in ram_budget!")
+
+    def _resize_cache(self) -> bool:
+        # Swap the file cache for one of the max_cache size, keeping the old one if it doesn't fit.
+        size = len(self._file_cache)
+        self.buffers.release(self._file_cache)
+        self._file_cache = self.buffers.lease(self._max_cache * self._maxbuf)
+        if self._file_cache is not None:
+            return True
+        self._file_cache = self.buffers.lease(size)
+        self._max_cache = size // self._maxbuf
+        return False
+
+    @property
+    def fs(self):
+        """
+        The filesystem backend being served, see flash_fs, ram_fs and mount_fs.
+        """
+        return self._fs
+
+    @fs.setter
+    def fs(self, value) -> None:
+        self._fs = value
+        self.meta.fs = value
+        self._changed(None)
+
+    @property
+    def max_sessions(self) -> int:
+        # How many clients can be connected at once.
+        return len(self._sessions)
+
+    @property
+    def sessions(self) -> list:
+        # The currently connected sessions.
+        return [i for i in self._sessions if i is not None]
+
+    @property
+    def pending(self) -> bool:
+        """
+        True while there is work left for poll(): queued commands, unsent
+        replies or a transfer still in progress.
+        """
+        for s in self._sessions:
+            if s is not None and (s.queue or s.out or s.xfer is not None):
+                return True
+        return False
+
+    def stats(self) -> dict:
+        """
+        A snapshot of the metrics plus gc and buffer figures.
+        """
+        m = self.metrics
+        return {
+            "bytes_tx": m.bytes_tx,
+            "bytes_rx": m.bytes_rx,
+            "tx_rate": m.tx_rate,
+            "rx_rate": m.rx_rate,
+            "last_tx_rate": m.last_tx_rate,
+            "last_rx_rate": m.last_rx_rate,
+            "transfers": m.transfers,
+            "aborted": m.aborted,
+            "pasv_setups": m.pasv_setups,
+            "pasv_time": m.pasv_time,
+            "kicked": m.kicked,
+            "timeouts": m.timeouts,
+            "data_timeouts": m.data_timeouts,
+            "throttled": self.bandwidth.held,
+            "commands": m.commands,
+            "gc_collections": self.gc.collections,
+            "gc_time": self.gc.collect_time,
+            "mem_free": mem_free() if mem_free is not None else None,
+            "rx_buf": len(self._rx_buf),
+            "file_cache": len(self._file_cache),
+            "file_cache_used": self._cache_owner is not None,
+            "ram_used": self.buffers.used,
+            "ram_leased": self.buffers.leased,
+            "ram_peak": self.buffers.peak,
+            "ram_budget": self.buffers.budget,
+            "ram_denied": self.buffers.denied,
+            "meta_used": self.meta.used,
+            "meta_hits": self.meta.hits,
+            "meta_misses": self.meta.misses,
+            "content_used": self.content.used,
+            "content_hits": self.content.hits,
+            "content_misses": self.content.misses,
+            "digest_hits": self.digests.hits,
+            "digest_misses": self.digests.misses,
+            "pending_replies": sum(len(i.out) for i in self.sessions),
+            "sessions": len(self.sessions),
+        }
 
     @property
     def user(self):
         if self.deinited or not self.authenticated:
             return
         # Returns the connected username, if it exists.
-        return self._tmpuser if self._tmpuser is not None else ""
+        if self._cur is None or self._cur.user is None:
+            return ""
+        return self._cur.user
 
     @property
     def pasv(self) -> None:
         # Returns True if a passive connection is active
-        return self._pasv
+        return self._cur is not None and self._cur.pasv
 
     @property
     def authenticated(self) -> bool:
         if self.deinited:
             return
-        return self._authenticated
+        if self._cur is None:
+            return not bool(len(self._authlist))
+        return self._cur.authenticated
 
     @property
     def connected(self) -> bool:
         # Is a client connected
         if self.deinited:
             return
-        return self._conn is not None
+        return self._cur is not None
 
     def disconnect(self) -> None:
-        # Disconnect and clear the connections.
+        # Disconnect and clear all the connections.
         if self.deinited:
             return
-        self._reset_data_sock()
-        if self._conn is not None:
-            if self.verbose:
-                print("Disconnected {}:{}".format(self.client[0], self.client[1]))
-            self._conn.close()
-            self._conn = None
-        self._reset_rx_buffer()
-        if self.pasv:
-            self._pasv = False
-        self._reset_data_sock()
-        self._authenticated = not bool(len(self._authlist))
-        chdir("/")
+        for i in self.sessions:
+            self._drop(i)
 
     @property
     def client(self):
         """
-        Returns a tuple with the connected client's ip and port.
+        Returns a tuple with the last serviced client's ip and port.
         If no connection, returns None.
         """
         if self.deinited:
             return
-        return self._client if self.connected else None
+        return self._cur.client if self.connected else None
 
-    def serve_till_quit(self) -> None:
-        # Run the server till a client exits.
+    def serve_till_quit(self, timeout=1) -> None:
+        # Run the server till a client exits, sleeping while there's nothing to do.
         if self.deinited:
             return
-        while not self.poll():
+        while not self.poll(timeout):
             pass
 
-    def serve(self) -> None:
-        # Run the server forever
+    def serve(self, timeout=1) -> None:
+        # Run the server forever, sleeping while there's nothing to do.
         if self.deinited:
             return
         while True:
+            self.poll(timeout)
+
+    @property
+    def writable(self) -> bool:
+        # Is the filesystem currently mounted writable by us.
+        return self._rw
+
+    def begin_write(self) -> bool:
+        """
+        Remount the filesystem writable and keep it so until end_write().
+        Use it around bursts of your own writes, or to hold the window open for a deploy.
+        Returns False if it can't be, like while the drive is visible over USB.
+        The window doesn't nest, a single end_write() closes it.
+        """
+        if self.deinited:
+            return False
+        if not self._held:
+            self._held = self._remount_rw()
+        return self._held
+
+    def end_write(self) -> None:
+        # Close the window opened by begin_write(), remounting read-only right away.
+        if self.deinited or not self._held:
+            return
+        self._held = False
+        self._writers -= 1
+        self._close_write()
+
+    async def serve_async(self, timeout=1) -> None:
+        """
+        Run the server forever as an asyncio task.
+        Instead of spinning, it awaits until one of its sockets is ready,
+        or at most timeout seconds, so other tasks get the cpu meanwhile.
+        """
+        while not self.deinited:
             self.poll()
+            await self._wait_ready(timeout)
 
-    def poll(self) -> bool:
+    def poll(self, timeout=0, budget_ms=None) -> bool:
         """
         This is what runs the server. You need this to run in a while True.
         serve() and serve_till_quit() do this.
 
+        With a timeout, it first sleeps until one of the server's sockets is ready,
+        for at most timeout seconds, so an idle server leaves the cpu alone.
+        That includes the data sockets, a transfer wakes it as soon as its data
+        connection can move, and a throttled one once its tokens are back.
+        Queued commands, HASH and COPY don't wait at all.
+
+        With a budget_ms, it keeps running commands and moving chunks for about that
+        many milliseconds, then returns with the rest left for the next call.
+        It stops early once nothing moves anymore, and it won't start another round
+        unless the slowest one so far still fits. A single chunk can't be cut short,
+        so keep tx_size and maxbuf small when the bound must be tight.
+        Check pending to know if there is more work waiting.
+
+        Every call accepts at most one new client and then services each connected
+        session once, starting from a different one every time so none is starved.
+
         This function returns False every time, except if on this loop, it disconnected a client.
         For this condition, both manual disconnections and lost connections count, since filezilla
         is not very kind to us.
@@ -191,620 +1727,1502 @@ class ftp:
         """
         if self.deinited:
             return False
-        """
-        Use this function to poll the server
-        """
+        if timeout:
+            self._wait(timeout)
         res = False
-        if self._ensure_conn():
+        if self._rw and monotonic() - self._rw_idle > self.write_idle:
+            self._close_write()
+        self._connect()
+        count = len(self._sessions)
+        start = self._next
+        self._next = (start + 1) % count
+        if budget_ms is not None:
+            self._deadline = monotonic_ns() + int(budget_ms * 1000000)
+        slowest = 0
+        while True:
+            began = monotonic_ns()
+            done = self._done
+            for i in range(count):
+                s = self._sessions[(start + i) % count]
+                if s is not None and self._poll_session(s):
+                    res = True
+            if self._deadline is None or self._done == done:
+                break
+            now = monotonic_ns()
+            slowest = max(slowest, now - began)
+            if now + slowest > self._deadline:
+                break
+        self._deadline = None
+        return res
+
+    def deinit(self) -> None:
+        # Destroy the object effectively
+        if self.deinited:
+            return
+        self.disconnect()
+        self._writers = 0  # Closes a window left open by begin_write() too.
+        self._held = False
+        self._close_write()
+        self._socket.close()
+        del (
+            self.pasv_port,
+            self.pasv_range,
+            self.auth_timeout,
+            self.tx_size,
+            self.block_size,
+            self.verbose,
+            self._max_cache,
+            self.mode,
+            self.ro,
+            self.gc,
+            self.meta,
+            self._pool,
+            self._socket,
+            self._iptup,
+            self._sessions,
+            self._cur,
+            self._next,
+            self._rx_buf,
+            self._maxbuf,
+            self._authlist,
+            self._file_cache,
+            self._cache_owner,
+            self._writers,
+            self._rw,
+            self._rw_idle,
+            self._held,
+            self.write_idle,
+            self._done,
+            self._deadline,
+            self.buffers,
+            self.metrics,
+            self.bandwidth,
+            self._fs,
+            self.content,
+            self.z_level,
+            self.z_wbits,
+            self.digests,
+            self.stor_hash,
+        )
+        self.deinited = True
+
+    # Internal functions passed this point. Do not touch. Or do. Idc.
+
+    def _poll_session(self, s) -> bool:
+        # Service a single session. Returns True if it disconnected.
+        self._cur = s
+        if self._ensure_conn(s):
             return True
-        if not self._connect():
-            return res
-        if (not self.authenticated) and (monotonic() - self._timer > self.auth_timeout):
-            self._kick(self.client)
-            self.disconnect()
-            return res
-        try:
-            size = self._conn.recv_into(self._rx_buf, self._maxbuf)
-            if size:
-                try:
-                    raw = bytes(memoryview(self._rx_buf)[:size]).decode(_enc)
-                    cmds = raw.split("\r\n")[:-1]
-                    if self.verbose:
-                        print("Commands:", cmds)
-                    if "ABOR" in cmds:
-                        cmds = []
-                        self._reset_data_sock()
-                        self._send_msg(26)
-                        if self.verbose:
-                            print("Aborted.")
-                    for i in cmds:
-                        data = i.split(" ")
-                        if self.verbose:
-                            print("Current data line:", data)
-                        command = data[0].lower()
-                        if command == "user":
-                            self._user(data)
-                        elif command == "pass":
-                            self._pass(data)
-                        elif command == "syst":
-                            self._syst()
-                        elif command == "pwd":
-                            self._pwd()
-                        elif command == "cwd":
-                            self._cwd(data)
-                        elif command == "cdup":
-                            self._cdup()
-                        elif command in ["list", "nlist"]:
-                            self._list(data)
-                        elif command == "port":
-                            self._port(data)
-                        elif command == "size":
-                            self._size(data)
-                        elif command == "type":
-                            self._type(data)
-                        elif command == "pasv":
-                            self._enpasv()
-                        elif command == "noop":
-                            self._send_msg(14)
-                        elif command == "retr":
-                            self._retr(data)
-                        elif command == "stor":
-                            self._stor(data)
-                        elif command == "dele":
-                            self._dele(data)
-                        elif command == "rmd":
-                            self._rmd(data)
-                        elif command == "mkd":
-                            self._mkd(data)
-                        elif command == "rnfr":
-                            self._rnfr(data)
-                        elif command == "rnto":
-                            self._rnto(data)
-                        elif command == "appe":
-                            self._stor(data, True)
-                        elif command == "quit":
-                            self._send_msg(15)
-                            self.disconnect()
-                            res = True
-                        else:
-                            self._send_msg(0)
-                            if self.verbose:
-                                print("Unknown command:", command)
-                        if self.verbose:
-                            print("Done with command.")
-                        del command, data
-                        collect()
-                        collect()
-                        collect()
-                        collect()
-                    del raw, cmds
-                except UnicodeError:
-                    pass
+        if (not s.authenticated) and (monotonic() - s.timer > self.auth_timeout):
+            self._kick(s.client)
+            self.metrics.timeouts += 1
+            self._drop(s)
+            return False
+        res = False
+        try:
+            size = s.conn.recv_into(self._rx_buf, self._maxbuf)
+            if not size:  # Orderly shutdown from the client.
+                self._drop(s)
+                return True
+            self._assemble(s, size)
             del size
+        except BrokenPipeError:
+            self._drop(s)
+            return True
+        except OSError:
+            pass
+        try:
+            self._flush(s)
+            res = self._run_cmds(s)
+            if res or self._sessions[s.slot] is not s:
+                return res
+            if s.xfer is not None:
+                self._step(s)
+        except BrokenPipeError:
+            self._drop(s)
+            res = True
+        except OSError:
+            pass
+        return res
+
+    def _assemble(self, s, size) -> None:
+        # Cut what was received into command lines, straight from the receive buffer.
+        # An unfinished line is kept for the next poll. ABOR is acted on right away.
+        buf = self._rx_buf
+        mv = memoryview(buf)
+        start = 0
+        while True:
+            end = _find(buf, b"\n", start, size)
+            if end < 0:
+                break
+            if s.rx:  # Started in an earlier segment.
+                line = (s.rx + bytes(mv[start:end])).rstrip(b"\r").lstrip(b"\xff\xf4\xf2")
+                s.rx = b""
+            else:
+                a = start
+                b = end - 1 if end > start and buf[end - 1] == 13 else end
+                while a < b and buf[a] in (0xFF, 0xF4, 0xF2):  # Telnet IP/Synch
+                    a += 1
+                line = bytes(mv[a:b])
+            start = end + 1
+            self.gc.note(len(line) + 16)
+            try:
+                line = line.decode(_enc)
+            except UnicodeError:
+                s.queue.append("")  # Gets a syntax error reply, in order.
+                continue
+            if self.verbose:
+                print("Command:", line)
+            if line.upper() == "ABOR":
+                s.queue = []
+                self._abor(s)
+            else:
+                s.queue.append(line)
+        if start < size:
+            s.rx = s.rx + bytes(mv[start:size]) if s.rx else bytes(mv[start:size])
+            if len(s.rx) >= self._maxbuf:  # Nobody sends lines this long.
+                s.rx = b""
+                s.queue.append("")
+
+    def _run_cmds(self, s) -> bool:
+        # Run the queued commands. Returns True if the client quit.
+        ran = False
+        while s.queue:
+            line = s.queue[0].split(" ", 1)
+            command = line[0].lower()
+            arg = line[1] if len(line) > 1 else ""
+            entry = _cmds.get(command)
+            flags = entry[1] if entry is not None else 0
+            if s.xfer is not None and not flags & _C_ANYTIME:
+                break  # Wait for the transfer to finish first.
+            if ran and self._deadline is not None and monotonic_ns() > self._deadline:
+                break  # Out of budget, the rest waits for the next poll.
+            s.queue.pop(0)
+            self._done += 1
+            ran = True
+            if entry is None:
+                self._send_msg(s, 0)
+                if self.verbose:
+                    print("Unknown command:", command)
+            elif flags & _C_AUTH and not s.authenticated:
+                self._send_msg(s, 7)
+            elif flags & _C_ARG and not arg:
+                self._send_msg(s, 0)
+            elif flags & _C_WRITE and self.ro:
+                self._send_msg(s, 20)
+            else:
+                began = monotonic_ns()
+                try:
+                    quit = entry[0](self, s, arg)
+                except (ValueError, IndexError):  # Malformed arguments.
+                    self._send_msg(s, 0)
+                    quit = False
+                self.metrics.command(command, monotonic_ns() - began)
+                if quit:
+                    return True
+            if entry is None or entry[0] is not ftp._rest:
+                s.rest = 0  # Only holds for the command right after REST.
+            self.gc.note(len(command) + len(arg) + 32)
+            del command, arg, line, entry
+            self.gc.point(self._transferring())
+            if self._sessions[s.slot] is not s:
+                break  # Dropped by the command.
+        return False
+
+    def _noop(self, s, arg) -> None:
+        self._send_msg(s, 14)
+
+    def _quit(self, s, arg) -> bool:
+        self._send_msg(s, 15)
+        self._drop(s)
+        return True
+
+    def _appe(self, s, arg) -> None:
+        self._stor(s, arg, True)
+
+    def _abor(self, s) -> None:
+        if s.xfer is not None:
+            self._end_xfer(s, 27)
+        else:
+            self._reset_data_sock(s)
+        self._send_msg(s, 26)
+        if self.verbose:
+            print("Aborted.")
+
+    def _interest(self, timeout):
+        # The sockets worth waking up for, and how long sleeping is fine at most.
+        # Only queued commands and local work, HASH, COPY and upload flushes, keep it at 0.
+        # nap is how long a sleep without readiness support may take, 0 with a data socket to serve.
+        rd = [self._socket]
+        wr = []
+        nap = True
+        now = monotonic()
+        if self._rw and not self._writers:  # Till the read-only remount is due.
+            timeout = min(timeout, max(0, self._rw_idle + self.write_idle - now))
+        for s in self.sessions:
+            rd.append(s.conn)
+            if s.out:
+                wr.append(s.conn)
+            if s.queue:
+                timeout = 0
+            if not s.authenticated:
+                timeout = min(timeout, max(0, s.timer + self.auth_timeout - now))
+            t = s.xfer
+            if t is None:
+                continue
+            if t.kind == _HASH or t.kind == _COPY or (t.kind == _STOR and t.ready):
+                timeout = 0  # Local work, nothing to wait for.
+            elif s.data_socket is None:
+                if s.pasv_sock is not None:
+                    rd.append(s.pasv_sock)
+                timeout = min(timeout, max(0, t.start + 2 - now))
+            else:
+                wait = self.bandwidth.delay(t.kind != _STOR)
+                if wait:  # Throttled, the socket can wait for the tokens.
+                    timeout = min(timeout, wait)
+                elif t.kind == _STOR:
+                    rd.append(s.data_socket)
+                    nap = False
+                else:
+                    wr.append(s.data_socket)
+                    nap = False
+        return rd, wr, timeout, timeout if nap else 0
+
+    def _wait(self, timeout) -> None:
+        # Sleep until a socket is ready, with select.poll if the pool's sockets support it.
+        rd, wr, timeout, nap = self._interest(timeout)
+        if not timeout:
+            return
+        try:
+            from select import poll, POLLIN, POLLOUT
+
+            p = poll()
+            masks = {}
+            for i in rd:
+                masks[i] = POLLIN
+            for i in wr:
+                masks[i] = masks.get(i, 0) | POLLOUT
+            for i in masks:
+                p.register(i, masks[i])
+        except (ImportError, TypeError, ValueError, OSError):
+            # No readiness support, a short nap still keeps the cpu mostly free.
+            if nap:
+                sleep(min(nap, 0.02))
+            return
+        p.poll(int(timeout * 1000) + 1)  # Rounded up, 0 wouldn't wait.
+
+    async def _wait_ready(self, timeout) -> None:
+        import asyncio
+
+        rd, wr, timeout, nap = self._interest(timeout)
+        loop = asyncio.get_event_loop()
+        if not hasattr(loop, "add_reader"):
+            # No readiness callbacks here (CircuitPython), just yield.
+            await asyncio.sleep(0 if wr else min(nap, 0.05))
+            return
+        if not timeout:
+            await asyncio.sleep(0)
+            return
+        fut = loop.create_future()
+
+        def wake() -> None:
+            if not fut.done():
+                fut.set_result(None)
+
+        for i in rd:
+            loop.add_reader(i, wake)
+        for i in wr:
+            loop.add_writer(i, wake)
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            for i in rd:
+                loop.remove_reader(i)
+            for i in wr:
+                loop.remove_writer(i)
+
+    def _drop(self, s) -> None:
+        # Close a session and free its slot.
+        if s.xfer is not None:
+            self._end_xfer(s, None)
+        self._reset_data_sock(s)
+        self._close_pasv(s)
+        if self.verbose:
+            print("Disconnected {}:{}".format(s.client[0], s.client[1]))
+        try:
+            self._flush(s)  # Last words, if the socket takes them.
         except OSError:
             pass
-        except BrokenPipeError:
-            self.disconnect()
-        return res
-
-    def deinit(self) -> None:
-        # Destroy the object effectively
-        if self.deinited:
-            return
-        self.disconnect()
-        del (
-            self.pasv_port,
-            self.data_ip,
-            self.data_port,
-            self.auth_timeout,
-            self.tx_size,
-            self.verbose,
-            self._max_cache,
-            self.mode,
-            self.ro,
-            self._pool,
-            self._socket,
-            self._data_socket,
-            self._iptup,
-            self._conn,
-            self._client,
-            self._client_pasv,
-            self._rx_buf,
-            self._maxbuf,
-            self._authenticated,
-            self._pasv,
-            self._pasv_sock,
-            self._pollt,
-            self._authlist,
-            self._tmpuser,
-            self._timer,
-            self._file_cache,
-            self._rename_from,
-        )
-        self.deinited = True
+        try:
+            s.conn.close()
+        except:
+            pass
+        self._sessions[s.slot] = None
+        self._close_write()
+        if self._cur is s:
+            self._cur = None
+            for i in self._sessions:
+                if i is not None:
+                    self._cur = i
+                    break
 
-    # Internal functions passed this point. Do not touch. Or do. Idc.
+    def _s_send(self, s, data) -> None:
+        # Queue a reply and send as much of it as the socket takes right now.
+        s.out = s.out + data if s.out else data
+        self._flush(s)
 
-    def _s_send(self, data) -> None:
-        res = 0
-        mv = memoryview(data)
-        while res != len(data):
-            try:
-                res += self._conn.send(mv[res:])
-            except OSError:
-                pass
+    def _flush(self, s) -> None:
+        # Push out pending replies without waiting on the socket.
+        if not s.out:
+            return
+        try:
+            s.out = s.out[s.conn.send(s.out) :]
+        except BrokenPipeError:
+            raise
+        except OSError as err:
+            if not _would_block(err):
+                raise
 
-    def _d_send(self, data) -> None:
-        res = 0
-        mv = memoryview(data)
-        while res != len(data):
-            try:
-                res += self._data_socket.send(mv[res:])
-            except OSError:
-                pass
+    def _path(self, s, path) -> str:
+        # Resolve a client supplied path against the session's working directory.
+        if not path.startswith("/"):
+            path = s.cwd + "/" + path
+        parts = []
+        for i in path.split("/"):
+            if i == "..":
+                if parts:
+                    parts.pop()
+            elif i and i != ".":
+                parts.append(i)
+        return "/" + "/".join(parts)
 
-    def _user(self, data) -> None:
+    def _user(self, s, arg) -> None:
         # Username reading.
         if len(self._authlist):
-            user = data[1]
+            user = arg
             if user not in self._authlist.keys():
-                self._send_msg(0)
+                self._send_msg(s, 0)
             elif self._authlist[user] is None:
-                self._send_msg(1)
-                self._authenticated = True
-                self._tmpuser = user
-                self._logon()
+                self._send_msg(s, 1)
+                s.authenticated = True
+                s.user = user
+                self._logon(s)
             else:
-                self._send_msg(2)
-                self._tmpuser = user
+                self._send_msg(s, 2)
+                s.user = user
             del user
         else:
-            self._send_msg(1)
+            self._send_msg(s, 1)
 
-    def _pass(self, data) -> None:
+    def _pass(self, s, arg) -> None:
         # Read the password and auth if correct.
-        if self.user is not None:
-            passwd = data[1]
-            if passwd == self._authlist[self.user]:
-                self._send_msg(1)
-                self._authenticated = True
-                self._logon()
+        if s.user is not None:
+            passwd = arg
+            if passwd == self._authlist[s.user]:
+                self._send_msg(s, 1)
+                s.authenticated = True
+                self._logon(s)
             else:
-                self._send_msg(1)
-                self.disconnect()
+                self._send_msg(s, 1)
+                self._drop(s)
             del passwd
         else:
-            self._send_msg(0)
-
-    def _syst(self) -> None:
-        if not self._authcheck():
-            return
-        self._send_msg(4)
-
-    def _retr(self, data) -> None:
-        if not self._authcheck():
-            return
-        filen = data[1]
-        self._enable_data()
-        try:
-            with open(filen, "r" if self.mode else "rb") as f:
-                self._send_msg(17)
-                while True:
-                    collect()
-                    collect()
-                    dat = f.read(self.tx_size) # Reading in chunks
-                    if not dat:
-                        del dat
-                        break
-                    if self.mode:
-                        dat = dat.encode(_enc)
-                    self._d_send(dat)
-                    del dat
-                    collect()
-            self._send_msg(19)
-        except OSError:
-            self._send_msg(18)
-        self._disable_data()
+            self._send_msg(s, 0)
+
+    def _syst(self, s, arg) -> None:
+        self._send_msg(s, 4)
 
-    def _stor(self, data, append=False) -> None:
-        if not self._authcheck():
+    def _retr(self, s, arg) -> None:
+        filen = self._path(s, arg)
+        f = data = None
+        try:
+            if self.content.max_bytes and not s.zmode and not s.mode:
+                stati = self._fs.stat(filen)  # Fresh, the host may have rewritten it.
+                data = self.content.get(filen, stati)
+                if data is None and self.content.wants(stati):
+                    with self._fs.open(filen, "rb") as f:
+                        data = f.read()
+                    f = None
+                    self.content.put(filen, stati, data)
+            if data is None:
+                f = self._fs.open(filen, "rb")  # UTF-8 goes out as is, no need to decode it.
+                if s.rest:
+                    f.seek(s.rest)
+        except OSError:
+            self._send_msg(s, 18)
+            self._disable_data(s)
             return
-        self._enable_data()
+        block = None
+        if f is not None:
+            block = self._lease_block(s)
+            if block is None:
+                f.close()
+                return
+        if not self._enable_data(s):
+            if f is not None:
+                f.close()
+                self.buffers.release(block)
+            return
+        self._send_msg(s, 17)
+        s.xfer = _transfer(_RETR, f)
+        s.xfer.ascii = s.mode
+        if s.zmode:
+            s.xfer.z = _compressor(self.z_level, self.z_wbits)
+        if data is not None:  # Straight from the content cache.
+            s.xfer.buf = memoryview(data)[s.rest :]
+        s.xfer.block = block
+
+    def _stor(self, s, arg, append=False) -> None:
         try:
-            if self.ro:
-                raise RuntimeError
-            remount("/", False)
-            filen = data[1]
-            mod = "w" if self.mode else "wb"
+            filen = self._path(s, arg)
+            mod = "wb"  # TYPE A gets translated on the way in, see _ascii_in.
+            pos = s.rest
             if append:
-                mod = "a" if self.mode else "ab"
-                with open(filen):
-                    pass  # Ensure it exists
-            self._s_send(b"150 Opening data connection for {}\r\n".format(filen))
-            with open(filen, mod) as f:
-                cache_stored = 0
-                while True:
-                    size = 0
-                    try:
-                        size = self._data_socket.recv_into(self._rx_buf, self._maxbuf)
-                        if self._max_cache and (
-                            cache_stored + size > self._max_cache * self._maxbuf
-                        ):
-                            f.write(bytes(memoryview(self._file_cache)[:cache_stored]))
-                            cache_stored = 0
-                            collect()
-                            collect()
-                        self._file_cache[cache_stored:size] = memoryview(self._rx_buf)[
-                            :size
-                        ]
-                        cache_stored += size
-                    except OSError:
-                        try:
-                            self._data_socket.send(b"")
-                        except BrokenPipeError:
-                            break
-                if cache_stored:
-                    f.write(bytes(memoryview(self._file_cache)[:cache_stored]))
-                    collect()
-                    collect()
-            self._send_msg(19)
-            remount("/", True)
-        except RuntimeError:
-            self._send_msg(20)
+                mod = "ab"
+                pos = self.meta.stat(filen)[6]  # Ensure it exists
+            elif pos:
+                mod = "r+b"  # Resuming, keep what's there.
+            z = None
+            if s.zmode:
+                z = _decompressor()
+                if z is None:
+                    self._send_msg(s, 29)  # Can only compress here.
+                    self._disable_data(s)
+                    return
+            if not self._enable_data(s):
+                return
+            if not self._remount_rw(filen):
+                self._send_msg(s, 20)
+                self._disable_data(s)
+                return
+            try:
+                f = self._fs.open(filen, mod)
+                if mod[0] == "r":
+                    f.seek(pos)
+            except OSError:
+                self._remount_ro()
+                raise
+            finally:
+                self._changed(filen)
+            self._s_send(
+                s, "150 Opening data connection for {}\r\n".format(filen).encode(_enc)
+            )
+            s.xfer = _transfer(_STOR, f)
+            s.xfer.pos = pos
+            s.xfer.path = filen
+            s.xfer.z = z
+            s.xfer.ascii = s.mode
+            if self.stor_hash and not pos:  # Partial uploads can't be digested.
+                s.xfer.h = _hasher(s.hash)
+                s.xfer.algo = s.hash
+            if self._cache_owner is None and z is None:
+                self._cache_owner = s.xfer
+            return
         except OSError:  # Append failed
-            self._send_msg(18)
-        self._disable_data()
+            self._send_msg(s, 18)
+        self._disable_data(s)
+
+    def _step(self, s) -> None:
+        # Move a single chunk of the running transfer.
+        t = s.xfer
+        if t.kind == _HASH or t.kind == _COPY:
+            self._done += 1  # Local work, always moving.
+            if t.kind == _HASH:
+                self._hash_step(s, t)
+            else:
+                self._copy_step(s, t)
+            return
+        if t.begin is None:
+            if s.data_socket is None and not self._accept_data(s):
+                if monotonic() - t.start > 2:
+                    if self.verbose:
+                        print("PASV timed out!")
+                    self.metrics.data_timeouts += 1
+                    self._end_xfer(s, 28)
+                return
+            t.begin = monotonic()
+            if s.pasv:
+                self.metrics.pasv_setups += 1
+                self.metrics.pasv_time += t.begin - t.start
+        moved = t.moved
+        if t.kind == _STOR:
+            self._stor_step(s, t)
+        else:
+            self._send_step(s, t)
+        if t.moved != moved or s.xfer is not t:
+            self._done += 1
+
+    def _hash_step(self, s, t) -> None:
+        # Digest a chunk of the file, reply once all of it went through.
+        try:
+            size = t.f.readinto(t.block)
+        except OSError:
+            self._end_xfer(s, 25)
+            return
+        if size:
+            t.h.update(memoryview(t.block)[:size])
+            return
+        digest = t.h.digest()
+        self._end_xfer(s, None)
+        # Keyed by the stat from before reading, a file changed meanwhile won't match later.
+        self.digests.put(t.path, t.stati, t.algo, digest)
+        self._hash_reply(s, t.path, t.algo, t.stati[6], digest, t.x)
 
+    def _copy_step(self, s, t) -> None:
+        # Copy a chunk, through the file cache if free. Whole blocks only, so the writes stay aligned.
+        buf = self._file_cache if self._cache_owner is t else t.block
+        size = len(buf) - len(buf) % self.block_size or len(buf)
+        try:
+            size = t.src.readinto(memoryview(buf)[:size])
+            if size:
+                t.f.write(memoryview(buf)[:size])
+                t.moved += size
+                return
+        except OSError:
+            self._end_xfer(s, 25)  # Full disk perhaps.
+            return
+        self._end_xfer(s, 6)
 
-    def _type(self, data) -> None:
-        if not self._authcheck():
+    def _hash_reply(self, s, path, algo, size, digest, x) -> None:
+        digest = hexlify(digest)
+        if not x:
+            self._s_send(
+                s,
+                b"213 %s 0-%d %s %s\r\n" % (algo.encode(_enc), size, digest, path.encode(_enc)),
+            )
+        else:
+            self._s_send(s, b"250 %s\r\n" % (digest.upper() if algo == "CRC32" else digest))
+
+    def _send_step(self, s, t) -> None:
+        # RETR and LIST, the server is the one sending.
+        if t.sent == len(t.buf):
+            try:
+                t.buf = self._send_fill(t)
+            except OSError:
+                self._end_xfer(s, 25)  # Read failed.
+                return
+            t.sent = 0
+            if not t.buf:
+                self._end_xfer(s, 19 if t.kind == _RETR else 10)
+                return
+            self.gc.note(len(t.buf) if t.kind == _LIST else 16)
+            self.gc.point(True)
+        size = self.bandwidth.allow(True, len(t.buf) - t.sent)
+        if not size:
             return
-        modeset = data[1]
+        try:
+            size = s.data_socket.send(memoryview(t.buf)[t.sent : t.sent + size])
+            self.bandwidth.take(True, size)
+            t.sent += size
+            t.moved += size
+        except OSError as err:
+            if not _would_block(err):
+                self._end_xfer(s, 27)  # Client went away.
+
+    def _transferring(self) -> bool:
+        for i in self._sessions:
+            if i is not None and i.xfer is not None:
+                return True
+        return False
+
+    def _send_fill(self, t):
+        # The next chunk to send, compressed in MODE Z.
+        while True:
+            buf = self._retr_fill(t) if t.kind == _RETR else self._list_fill(t)
+            if t.z is None:
+                return buf
+            if not buf:
+                buf = t.z.flush()
+                t.z = None  # Nothing more to come after this.
+                return buf
+            buf = t.z.compress(buf)
+            if buf:
+                return buf
+
+    def _retr_fill(self, t):
+        # Read the next chunk straight into the transfer's buffer, nothing gets allocated.
+        if t.f is None:
+            return b""  # Came from the content cache, all sent.
+        if t.ascii:
+            return self._ascii_out(t)
+        size = t.f.readinto(t.block)
+        return memoryview(t.block)[:size] if size else b""
+
+    def _ascii_out(self, t):
+        # TYPE A download, bare LF becomes CRLF. Reads into the back half of the
+        # buffer and expands towards the front, the output never overtakes the input.
+        buf = t.block
+        mv = memoryview(buf)
+        half = len(buf) // 2
+        size = t.f.readinto(mv[half : 2 * half])
+        if not size:
+            return b""
+        end = half + size
+        last = buf[end - 1]
+        src = half
+        o = 0
+        while src < end:
+            j = _find(buf, b"\n", src, end)
+            if j < 0:
+                j = end
+            if j > src:
+                mv[o : o + j - src] = mv[src:j]
+                o += j - src
+            if j == end:
+                break
+            if (buf[j - 1] != 13) if j > half else not t.cr:
+                mv[o] = 13
+                o += 1
+            mv[o] = 10
+            o += 1
+            src = j + 1
+        t.cr = last == 13
+        return mv[:o]
+
+    def _ascii_in(self, t, buf, start, size) -> int:
+        # TYPE A upload, CRLF becomes LF in place in buf[start : start + size].
+        # Returns the new size. A CR ending the chunk is held back in t.cr,
+        # the caller puts it in front of the next one.
+        size += start
+        t.cr = size > start and buf[size - 1] == 13
+        if t.cr:
+            size -= 1
+        mv = memoryview(buf)
+        src = o = start
+        while src < size:
+            j = _find(buf, b"\r", src, size)
+            if j < 0:
+                j = size
+            if j > src:
+                if o != src:
+                    mv[o : o + j - src] = mv[src:j]
+                o += j - src
+            if j == size:
+                break
+            if j + 1 == size or buf[j + 1] != 10:
+                mv[o] = 13  # Lone CR, kept.
+                o += 1
+            src = j + 1
+        return o - start
+
+    def _lease_block(self, s):
+        # A send buffer from the pool. None if over budget, with a 451 sent.
+        block = self.buffers.lease(self.tx_size)
+        if block is None:
+            self._send_msg(s, 25)
+            self._disable_data(s)
+        return block
+
+    def _stor_step(self, s, t) -> None:
+        owner = self._cache_owner is t
+        if owner:
+            half = len(self._file_cache) // 2
+            if t.cr and half - t.fill < 2:  # No room for the held back CR, see lead.
+                try:
+                    if t.ready:
+                        self._stor_flush(t)
+                    self._stor_swap(t, half)
+                except OSError:
+                    self._end_xfer(s, 25)
+                    return
+            base = t.bank * half
+            raw = self._file_cache
+            start = base + t.fill
+            buf = memoryview(raw)[start : base + half]
+        else:
+            raw = self._rx_buf
+            start = 0
+            buf = memoryview(raw)
+        lead = 1 if t.cr and t.z is None else 0  # TYPE A: room for the held back CR.
+        want = self.bandwidth.allow(False, min(len(buf) - lead, self._maxbuf))
+        if not want and not t.ready:
+            return  # Throttled, and no bank to flush meanwhile.
+        try:
+            try:
+                size = s.data_socket.recv_into(buf[lead:], want) if want else 0
+            except OSError as err:
+                if not _would_block(err):
+                    self._end_xfer(s, 27)
+                    return
+                try:
+                    s.data_socket.send(b"")
+                except BrokenPipeError:
+                    self._end_xfer(s, 19)
+                    return
+                size = 0
+                if not t.ready:
+                    return
+            else:
+                if want and not size:  # Client is done sending.
+                    self._end_xfer(s, 19)
+                    return
+                self.bandwidth.take(False, size)
+            t.moved += size
+            if size and t.ascii and t.z is None:
+                if lead:
+                    buf[0] = 13
+                size = self._ascii_in(t, raw, start, size + lead)
+            if t.h is not None and t.z is None:
+                t.h.update(buf[:size])
+            if not owner:
+                if t.z is not None:
+                    self._inflate(t, buf[:size])
+                else:
+                    t.f.write(buf[:size])
+                return
+            t.fill += size
+            if t.ready:  # The other bank, filled up before this chunk came in.
+                self._stor_flush(t)
+            if t.fill == half:
+                self._stor_swap(t, half)
+        except OSError:
+            self._end_xfer(s, 25)  # Write failed, full disk perhaps.
+
+    def _inflate(self, t, data) -> None:
+        # MODE Z upload, written out at most maxbuf at a time to keep RAM bounded.
+        # data None finishes the stream.
+        try:
+            if data is None:
+                out = t.z.flush()
+                t.z = None
+            else:
+                out = t.z.decompress(data, self._maxbuf)
+            while out:
+                if t.ascii:
+                    if t.cr:
+                        out = b"\r" + out
+                    out = bytearray(out)
+                    out = memoryview(out)[: self._ascii_in(t, out, 0, len(out))]
+                t.f.write(out)
+                if t.h is not None:
+                    t.h.update(out)
+                if t.z is None:
+                    break
+                out = t.z.decompress(t.z.unconsumed_tail, self._maxbuf)
+        except OSError:
+            raise
+        except Exception:  # zlib.error, the client sent garbage.
+            raise OSError("Bad MODE Z data!")
+
+    def _stor_swap(self, t, half) -> None:
+        # Hand the full bank to the writer and keep receiving into the other.
+        # Only whole blocks get written, the remainder moves along to the new bank.
+        n = t.fill - (t.pos + t.fill) % self.block_size
+        if n <= 0:
+            n = t.fill  # Bank smaller than a block, can't align.
+        mv = memoryview(self._file_cache)
+        base = t.bank * half
+        other = half - base
+        tail = t.fill - n
+        if tail:
+            mv[other : other + tail] = mv[base + n : base + t.fill]
+        t.ready = n
+        t.fill = tail
+        t.bank ^= 1
+
+    def _stor_flush(self, t) -> None:
+        # Write the bank waiting for the flash.
+        half = len(self._file_cache) // 2
+        base = (t.bank ^ 1) * half
+        t.f.write(memoryview(self._file_cache)[base : base + t.ready])
+        t.pos += t.ready
+        t.ready = 0
+        self.gc.point(True)
+
+    def _end_xfer(self, s, msg) -> None:
+        # Close the transfer, reply with msg unless None.
+        t = s.xfer
+        s.xfer = None
+        if t.begin is not None:
+            self.metrics.transfer(
+                t.kind != _STOR, t.moved, monotonic() - t.begin, msg in (10, 19)
+            )
+        try:
+            if t.kind == _STOR and t.z is not None and msg == 19:
+                self._inflate(t, None)
+            if self._cache_owner is t:
+                if t.ready:
+                    self._stor_flush(t)
+                if t.fill:
+                    base = t.bank * (len(self._file_cache) // 2)
+                    t.f.write(memoryview(self._file_cache)[base : base + t.fill])
+            if t.cr and t.kind == _STOR and msg == 19:  # TYPE A upload ending in a CR.
+                t.f.write(b"\r")
+                if t.h is not None:
+                    t.h.update(b"\r")
+            if t.f is not None:
+                t.f.close()
+            if t.src is not None:
+                t.src.close()
+        except OSError:
+            msg = 25 if msg is not None else None
+        if self._cache_owner is t:
+            self._cache_owner = None
+            if len(self._file_cache) != self._max_cache * self._maxbuf:
+                self._resize_cache()  # max_cache was changed during the upload.
+        if t.block is not None:
+            self.buffers.release(t.block)
+        if t.kind == _STOR or t.kind == _COPY:
+            self._remount_ro()
+            self._changed(t.path)
+            if t.h is not None and msg == 19:
+                try:
+                    self.digests.put(t.path, self._fs.stat(t.path), t.algo, t.h.digest())
+                except OSError:
+                    pass
+        self._disable_data(s)
+        if msg is not None:
+            self._send_msg(s, msg)
+
+    def _changed(self, path) -> None:
+        # Forget what the caches know about path, or about everything if None.
+        if path is None:
+            self.meta.clear()
+            self.content.clear()
+            self.digests.clear()
+        else:
+            self.meta.invalidate(path)
+            self.content.invalidate(path)
+            self.digests.invalidate(path)
+
+    def _remount_rw(self, path=None) -> bool:
+        # Make the filesystem writable for path, or all of it for None, counting the
+        # users so that overlapping uploads don't lock each other out.
+        # The backend skips remounts it already did.
+        # False if it can't be, CircuitPython refuses while the drive is visible over USB.
+        try:
+            self._fs.remount(True, path)
+        except RuntimeError:
+            return False
+        self._rw = True
+        self._writers += 1
+        return True
+
+    def _remount_ro(self) -> None:
+        # Done writing. The remount itself waits for write_idle, see _close_write.
+        self._writers -= 1
+        self._rw_idle = monotonic()
+        if not self.write_idle:
+            self._close_write()
+
+    def _close_write(self) -> None:
+        # Remount read-only, unless something is still writing.
+        if self._rw and not self._writers:
+            self._rw = False
+            try:
+                self._fs.remount(False)
+            except RuntimeError:
+                pass  # Taken over by USB meanwhile.
+
+    def _type(self, s, arg) -> None:
+        modeset = arg
         if modeset == "I":
-            self.mode = False
-            self._send_msg(12)
+            s.mode = False
+            self._send_msg(s, 12)
         else:  # Intentional fallback
-            self.mode = True
-            self._send_msg(13)
+            s.mode = True
+            self._send_msg(s, 13)
 
-    def _size(self, data) -> None:
-        if not self._authcheck():
+    def _mode(self, s, arg) -> None:
+        arg = arg.upper()
+        if arg == "S":
+            s.zmode = False
+        elif arg == "Z" and _has_z():
+            s.zmode = True
+        else:
+            self._send_msg(s, 29)
             return
-        item = data[1]
+        self._send_msg(s, 14)
+
+    def _size(self, s, arg) -> None:
+        item = self._path(s, arg)
         try:
-            self._s_send(b"213 " + str(stat(item)[6]).encode(_enc) + b"\r\n")
+            self._s_send(s, b"213 " + str(self.meta.stat(item)[6]).encode(_enc) + b"\r\n")
         except OSError:
-            self._s_send(b"550 SIZE could not be detected.\r\n")
+            self._s_send(s, b"550 SIZE could not be detected.\r\n")
 
-    def _cdup(self) -> None:
-        if not self._authcheck():
-            return
-        chdir("..")
-        self._send_msg(14)
+    def _cdup(self, s, arg) -> None:
+        s.cwd = self._path(s, "..")
+        self._send_msg(s, 14)
 
-    def _pwd(self) -> None:
-        if not self._authcheck():
-            return
-        self._s_send(b'257 "{}".\r\n'.format(getcwd()))
+    def _pwd(self, s, arg) -> None:
+        self._s_send(s, '257 "{}".\r\n'.format(s.cwd).encode(_enc))
 
-    def _cwd(self, data) -> None:
-        if not self._authcheck():
-            return
-        ndr = data[1]
+    def _cwd(self, s, arg) -> None:
+        ndr = self._path(s, arg)
         try:
-            chdir(ndr)
-            self._send_msg(6)
+            if not self.meta.stat(ndr)[0] & 0x4000:
+                raise OSError  # File
+            s.cwd = ndr
+            self._send_msg(s, 6)
         except OSError:
-            self._send_msg(5)
+            self._send_msg(s, 5)
         del ndr
 
-    def _enpasv(self) -> None:
-        if not self._authcheck():
-            return
-        self._pasv = True
-        self._reset_data_sock()
-        self._enable_data()
+    def _enpasv(self, s, arg) -> None:
+        s.pasv = True
+        self._reset_data_sock(s)
+        if s.pasv_sock is None:
+            if self.verbose:
+                print("Enabling PASV socket.")
+            if not self._open_pasv(s):
+                self._send_msg(s, 28)
+                return
+        else:
+            self._drain_pasv(s)
+        self._s_send(
+            s,
+            "227 Entering Passive Mode ({},{},{}).\r\n".format(
+                self._iptup[0].replace(".", ","), s.pasv_port // 256, s.pasv_port % 256
+            ).encode(_enc),
+        )
+
+    def _open_pasv(self, s) -> bool:
+        # Bind the session's passive listener, on the lowest free port of the range.
+        # It stays open for the whole session, so there is no setup per transfer.
+        used = [i.pasv_port for i in self.sessions if i.pasv_sock is not None]
+        port = self.pasv_port - 1
+        for i in range(self.pasv_range):
+            port += 1
+            if port == self._iptup[1]:
+                port += 1  # Never on top of the control listener, the range moves up by one.
+            if port in used:
+                continue
+            sock = self._get_sock()
+            try:
+                sock.bind((self._iptup[0], port))
+                sock.listen(2)
+            except OSError:  # Taken by something else.
+                sock.close()
+                continue
+            sock.setblocking(False)
+            s.pasv_sock = sock
+            s.pasv_port = port
+            return True
+        return False
+
+    def _drain_pasv(self, s) -> None:
+        # Drop connections left over from an earlier PASV that never got used.
+        while True:
+            try:
+                s.pasv_sock.accept()[0].close()
+            except OSError:
+                return
+
+    def _close_pasv(self, s) -> None:
+        if s.pasv_sock is not None:
+            try:
+                s.pasv_sock.close()
+            except:
+                pass
+            s.pasv_sock = None
 
-    def _port(self, data) -> None:
-        if not self._authcheck():
+    def _port(self, s, arg) -> None:
+        spl = arg.split(",")
+        try:
+            if len(spl) != 6:
+                raise ValueError
+            for i in range(6):
+                spl[i] = int(spl[i])
+                if not 0 <= spl[i] < 256:
+                    raise ValueError
+        except ValueError:
+            self._send_msg(s, 0)
             return
-        self._reset_data_sock()
-        self._pasv = False
-        self._reset_data_sock()
-        spl = data[1].split(",")
-        self.data_ip = ".".join(spl[:4])
-        self.data_port = (256 * int(spl[4])) + int(spl[5])
-        self._send_msg(11)
+        self._reset_data_sock(s)
+        self._close_pasv(s)
+        s.pasv = False
+        s.data_ip = "%d.%d.%d.%d" % tuple(spl[:4])
+        s.data_port = (256 * spl[4]) + spl[5]
+        self._send_msg(s, 11)
         if self.verbose:
             print("Sent port accept.")
         del spl
 
-    def _list(self, data) -> None:
-        if not self._authcheck():
-            return
-        dirl = None
-        for i in data[1:]:
-            if i[0] != "-":
-                dirl = i.replace("\r\n", "")
-                break
-        target = getcwd() if dirl is None else dirl
+    def _list(self, s, arg, fmt=_LIST) -> None:
+        dirl = arg
+        while dirl.startswith("-"):  # Options like -la, ignored.
+            dirl = dirl.split(" ", 1)[1] if " " in dirl else ""
+        target = self._path(s, dirl if dirl else ".")
         try:
-            if stat(target)[0] != 16384:
+            if not self.meta.stat(target)[0] & 0x4000:
                 raise OSError  # File
         except OSError:  # Does non exist
-            self._send_msg(9)
-            return
-        listing = listdir(target)
-        self._send_msg(8)
-        self._enable_data()
-        for i in listing:
-            stati = stat(i if target is None else f"{target}/{i}")
-            line = b""
-            if stati[0] == 32768:
-                line += b"-rwxrwxrwx 1"
-            else:
-                line += b"drwxrwxrwx 2"
-            line += b" nobody nobody " + str(stati[6]).encode(_enc) + b" "
-            date_sr = localtime(max(min(2145916800, stati[9]), 946684800))
-            del stati
-            if date_sr[1] == 1:
-                line += b"Jan"
-            elif date_sr[1] == 2:
-                line += b"Feb"
-            elif date_sr[1] == 3:
-                line += b"Mar"
-            elif date_sr[1] == 4:
-                line += b"Apr"
-            elif date_sr[1] == 5:
-                line += b"May"
-            elif date_sr[1] == 6:
-                line += b"Jun"
-            elif date_sr[1] == 7:
-                line += b"Jul"
-            elif date_sr[1] == 8:
-                line += b"Aug"
-            elif date_sr[1] == 9:
-                line += b"Sep"
-            elif date_sr[1] == 10:
-                line += b"Oct"
-            elif date_sr[1] == 11:
-                line += b"Nov"
-            elif date_sr[1] == 12:
-                line += b"Dec"
-            line += b" " + str(date_sr[2]).encode(_enc) + b" "
-            hr = str(date_sr[3]).encode(_enc)
-            if not len(hr) - 1:
-                line += "0"
-            line += hr + b":"
-            del hr
-            mint = str(date_sr[4]).encode(_enc)
-            if not len(mint) - 1:
-                line += "0"
-            line += mint
-            del mint
-            line += b" " + i.encode(_enc)
-            del date_sr
-            self._d_send(line + b"\r\n")
-        self._disable_data()
-        self._send_msg(10)
+            self._send_msg(s, 9)
+            return
+        block = self._lease_block(s)
+        if block is None:
+            return
+        if not self._enable_data(s):
+            self.buffers.release(block)
+            return
+        self._send_msg(s, 8)
+        s.xfer = _transfer(_LIST, None)
+        if s.zmode:
+            s.xfer.z = _compressor(self.z_level, self.z_wbits)
+        s.xfer.fmt = fmt
+        s.xfer.target = target.rstrip("/") + "/"
+        s.xfer.listing = self.meta.listing(target)
+        s.xfer.items = s.xfer.listing[0]
+        s.xfer.block = block
         del dirl, target
 
-    def _dele(self, data) -> None:
-        if not self._authcheck():
-            return
-        filename = data[1]
+    def _nlst(self, s, arg) -> None:
+        self._list(s, arg, _NLST)
+
+    def _mlsd(self, s, arg) -> None:
+        self._list(s, arg, _MLSD)
+
+    def _mlst(self, s, arg) -> None:
+        target = self._path(s, arg if arg else ".")
         try:
-            if self.ro:
-                raise RuntimeError
-            remount("/", False)
-            remove(filename)
-            remount("/", True)
-            self._send_msg(6)  # Command successful
+            facts = self._facts(self.meta.stat(target), target)
         except OSError:
-            self._send_msg(18)  # File not found
-        except RuntimeError:
-            self._send_msg(20)  # Can't write
+            self._send_msg(s, 18)
+            return
+        self._s_send(
+            s,
+            b"250-Listing %s\r\n %s\r\n250 End.\r\n" % (target.encode(_enc), facts),
+        )
 
-    def _rmd(self, data) -> None:
-        if not self._authcheck():
+    def _rest(self, s, arg) -> None:
+        try:
+            s.rest = int(arg)
+            if s.rest < 0:
+                raise ValueError
+        except ValueError:
+            s.rest = 0
+            self._send_msg(s, 0)
             return
-        dirname = data[1]
+        self._s_send(s, b"350 Restarting at %d.\r\n" % s.rest)
+
+    def _feat(self, s, arg) -> None:
+        feats = _feats + [b"MODE Z"] if _has_z() else _feats
+        algos = [i + "*" if i == s.hash else i for i in _hash_algos()]
+        feats = feats + [b"HASH " + ";".join(algos).encode(_enc)]
+        self._s_send(s, b"211-Features:\r\n " + b"\r\n ".join(feats) + b"\r\n211 End.\r\n")
+
+    def _hash(self, s, arg) -> None:
+        self._start_hash(s, arg, s.hash, False)
+
+    def _xcrc(self, s, arg) -> None:
+        self._start_hash(s, arg, "CRC32", True)
+
+    def _xsha256(self, s, arg) -> None:
+        self._start_hash(s, arg, "SHA-256", True)
+
+    def _start_hash(self, s, arg, algo, x) -> None:
+        # Reply from the digest cache, or read the file through the digest in poll().
+        filen = self._path(s, arg)
         try:
-            if self.ro:
-                raise RuntimeError
-            remount("/", False)
-            rmdir(dirname)
-            remount("/", True)
-            self._send_msg(6)  # Command successful
+            stati = self._fs.stat(filen)  # Fresh, the host may have rewritten it.
+            if not stati[0] & 0x8000:
+                raise OSError  # Directory
+            digest = self.digests.get(filen, stati, algo)
+            if digest is not None:
+                self._hash_reply(s, filen, algo, stati[6], digest, x)
+                return
+            h = _hasher(algo)
+            if h is None:
+                self._send_msg(s, 29)
+                return
+            f = self._fs.open(filen, "rb")
         except OSError:
-            self._send_msg(5)  # Directory not found
-        except RuntimeError:
-            self._send_msg(20)  # Can't write
+            self._send_msg(s, 18)
+            return
+        block = self._lease_block(s)
+        if block is None:
+            f.close()
+            return
+        s.xfer = _transfer(_HASH, f)
+        s.xfer.block = block
+        s.xfer.h = h
+        s.xfer.algo = algo
+        s.xfer.x = x
+        s.xfer.path = filen
+        s.xfer.stati = stati
+
+    def _opts(self, s, arg) -> None:
+        arg = arg.split(" ", 1)
+        name = arg[0].upper()
+        if name == "HASH":
+            if len(arg) > 1:
+                algo = arg[1].upper()
+                if algo not in _hash_algos():
+                    self._send_msg(s, 29)
+                    return
+                s.hash = algo
+            self._s_send(s, b"200 %s\r\n" % s.hash.encode(_enc))
+        elif name == "UTF8":
+            self._send_msg(s, 14)  # Always on.
+        else:
+            self._send_msg(s, 29)
+
+    def _site(self, s, arg) -> None:
+        arg = arg.split(" ", 1)
+        entry = _site_cmds.get(arg[0].lower())
+        arg = arg[1] if len(arg) > 1 else ""
+        if entry is None or (entry[1] & _C_ARG and not arg):
+            self._send_msg(s, 0)
+        elif entry[1] & _C_WRITE and self.ro:
+            self._send_msg(s, 20)
+        else:
+            entry[0](self, s, arg)
+
+    def _site_retrtar(self, s, arg) -> None:
+        # A whole directory tree as one tar stream.
+        target = self._path(s, arg)
+        try:
+            if not self.meta.stat(target)[0] & 0x4000:
+                raise OSError  # File
+            f = _tar_reader(self.meta, self._fs, target)
+        except OSError:
+            self._send_msg(s, 5)
+            self._disable_data(s)
+            return
+        block = self._lease_block(s)
+        if block is None:
+            f.close()
+            return
+        if not self._enable_data(s):
+            f.close()
+            self.buffers.release(block)
+            return
+        self._send_msg(s, 17)
+        s.xfer = _transfer(_RETR, f)
+        if s.zmode:
+            s.xfer.z = _compressor(self.z_level, self.z_wbits)
+        s.xfer.block = block
 
-    def _mkd(self, data) -> None:
-        if not self._authcheck():
+    def _site_stortar(self, s, arg) -> None:
+        # Unpack an uploaded tar stream into a directory, made if missing.
+        target = self._path(s, arg)
+        z = None
+        if s.zmode:
+            z = _decompressor()
+            if z is None:
+                self._send_msg(s, 29)
+                self._disable_data(s)
+                return
+        if not self._enable_data(s):
+            return
+        if not self._remount_rw(target):
+            self._send_msg(s, 20)
+            self._disable_data(s)
             return
-        dirname = data[1]
         try:
-            if self.ro:
-                raise RuntimeError
-            remount("/", False)
-            mkdir(dirname)
-            remount("/", True)
-            self._send_msg(6)  # Command successful
+            self.meta.stat(target)
         except OSError:
-            self._send_msg(5)  # Directory not found
-        except RuntimeError:
-            self._send_msg(20)  # Can't write
+            try:
+                self._fs.mkdir(target)
+            except OSError:
+                self._remount_ro()
+                self._send_msg(s, 5)
+                self._disable_data(s)
+                return
+        self._changed(None)
+        self._send_msg(s, 17)
+        s.xfer = _transfer(_STOR, _tar_writer(self._fs, target))
+        s.xfer.z = z  # path stays None, the whole tree may change.
+
+    def _site_cpfr(self, s, arg) -> None:
+        s.copy_from = self._path(s, arg)
+        self._send_msg(s, 30)
+
+    def _site_cpto(self, s, arg) -> None:
+        if s.copy_from is None:
+            self._send_msg(s, 0)  # CPFR missing
+            return
+        src = s.copy_from
+        s.copy_from = None
+        self._copy(s, src, self._path(s, arg))
 
-    def _rnfr(self, data) -> None:
-        if not self._authcheck():
+    def _site_copy(self, s, arg) -> None:
+        arg = arg.split(" ")
+        if len(arg) != 2:
+            self._send_msg(s, 0)  # Use CPFR and CPTO for names with spaces.
             return
-        self._rename_from = data[1]
-        self._send_msg(24)  # Command successful
+        self._copy(s, self._path(s, arg[0]), self._path(s, arg[1]))
 
-    def _rnto(self, data) -> None:
-        if not self._authcheck():
+    def _copy(self, s, src, dst) -> None:
+        # Start an on-device copy, poll() moves it a chunk at a time.
+        if src == dst:
+            self._send_msg(s, 23)
+            return
+        try:
+            if not self.meta.stat(src)[0] & 0x8000:
+                raise OSError  # Directory
+            f = self._fs.open(src, "rb")
+        except OSError:
+            self._send_msg(s, 18)
             return
-        if self._rename_from == None:
-            self._send_msg(0)  # Invalid request, RNFR missing
+        block = self._lease_block(s)
+        if block is None:
+            f.close()
+            return
+        if not self._remount_rw(dst):
+            f.close()
+            self.buffers.release(block)
+            self._send_msg(s, 20)
             return
-        rename_to = data[1]
         try:
-            if self.ro:
-                raise RuntimeError
-            remount("/", False)
-            rename(self._rename_from, rename_to)
-            remount("/", True)
-            self._send_msg(6)  # Command successful
+            out = self._fs.open(dst, "wb")
         except OSError:
-            self._send_msg(18)  # File not found
-        except RuntimeError:
-            self._send_msg(20)  # Can't write
+            f.close()
+            self.buffers.release(block)
+            self._remount_ro()
+            self._send_msg(s, 23)
+            return
         finally:
-            self._rename_from = None
+            self._changed(dst)
+        s.xfer = _transfer(_COPY, out)
+        s.xfer.src = f
+        s.xfer.path = dst
+        s.xfer.block = block
+        if self._cache_owner is None:
+            self._cache_owner = s.xfer
 
-    def _enable_data(self):  # If you are using ACTIVE, disable your firewall.
-        if self._pasv:
-            if self._data_socket is None:
-                if self.verbose:
-                    print("Enabling PASV socket.. ", end="")
-                if self._pasv_sock is not None:
-                    self._pasv_sock.close()
-                self._pasv_sock = self._get_sock()
-                self._pasv_sock.bind((self._iptup[0], self.pasv_port))
-                self._pasv_sock.listen(2)
-                self._pasv_sock.setblocking(False)
-                sleep(0.15)
-                self._s_send(
-                    b"227 Entering Passive Mode ("
-                    + self._iptup[0].replace(".", ",")
-                    + b","
-                    + str(int(self.pasv_port) // 256).encode(_enc)
-                    + b","
-                    + str(int(self.pasv_port) % 256).encode(_enc)
-                    + b").\r\n"
+    def _site_stats(self, s, arg) -> None:
+        lines = []
+        for key, value in self.stats().items():
+            if key == "commands":
+                continue
+            if isinstance(value, float):
+                value = "%.3f" % value
+            lines.append("%s: %s" % (key, value))
+        for verb, entry in self.metrics.commands.items():
+            lines.append(
+                "%s: %d, %.2f ms avg, <%s ms %s"
+                % (
+                    verb,
+                    entry[0],
+                    entry[1] * 1000 / entry[0],
+                    "/".join(str(i) for i in metrics.bounds),
+                    "/".join(str(i) for i in entry[2]),
                 )
-                timeout = monotonic()
-                while (monotonic() - timeout) < 2:
-                    try:
-                        self._data_socket, self._client_pasv = self._pasv_sock.accept()
-                        self._data_socket.setblocking(False)
-                        if self.verbose:
-                            print("Enabled PASV.")
-                        break
-                    except OSError:
-                        pass
-                if self._data_socket is None:
-                    if self.verbose:
-                        print("PASV timed out!")
-                    self._disable_data()
-                    self._send_msg(25)
-                    raise TimeoutError("Client did not connect.")
-        else:
-            if self.verbose:
-                    print("Connecting to ACTIVE socket..")
-            self._data_socket.connect((self.data_ip, self.data_port))
-            if self.verbose:
-                    print("Enabled ACTIVE.")
-        self._sock_state = True
+            )
+        self._s_send(
+            s,
+            b"211-Statistics:\r\n "
+            + "\r\n ".join(lines).encode(_enc)
+            + b"\r\n211 End.\r\n",
+        )
 
-    def _disable_data(self):
-        if self.verbose:
-            print("Disabled data socket")
-        self._reset_data_sock()
+    def _list_fill(self, t):
+        # Format as many listing lines as fit straight into the send buffer, b"" once done.
+        mv = memoryview(t.block)
+        used = 0
+        while t.index < len(t.items):
+            name = t.items[t.index]
+            try:
+                end = self._list_line(t, name, mv, used)
+            except OSError:  # Gone since listdir.
+                t.index += 1
+                continue
+            if end < 0:
+                if used:
+                    break
+                # Longer than the whole buffer, goes alone.
+                mv = memoryview(bytearray(4 * len(name) + 96))
+                end = self._list_line(t, name, mv, 0)
+            used = end
+            t.index += 1
+        return mv[:used] if used else b""
+
+    def _list_line(self, t, name, mv, at) -> int:
+        # Write the line for name at mv[at:], returning where it ends, -1 if it doesn't fit.
+        if t.fmt == _NLST:
+            return _put(mv, _put_str(mv, at, name), b"\r\n")
+        stati = self.meta.entry(t.listing, t.index)
+        if t.fmt == _MLSD:
+            return _put(mv, _put_facts(mv, at, stati, name), b"\r\n")
+        date_sr = localtime(max(min(2145916800, stati[9]), 946684800))
+        at = _put(
+            mv, at, b"-rwxrwxrwx 1 nobody nobody " if stati[0] & 0x8000 else b"drwxrwxrwx 2 nobody nobody "
+        )
+        at = _put(mv, _put_num(mv, at, stati[6]), b" ")
+        at = _put(mv, _put(mv, at, _months[date_sr[1] - 1]), b" ")
+        at = _put(mv, _put_num(mv, at, date_sr[2]), b" ")
+        at = _put(mv, _put_num(mv, at, date_sr[3], 2), b":")
+        at = _put(mv, _put_num(mv, at, date_sr[4], 2), b" ")
+        return _put(mv, _put_str(mv, at, name), b"\r\n")
 
-    def _connect(self) -> bool:
-        if self._conn is None:
+    def _facts(self, stati, name) -> bytes:
+        # RFC 3659 facts for MLST.
+        mv = memoryview(bytearray(4 * len(name) + 64))
+        return bytes(mv[: _put_facts(mv, 0, stati, name)])
+
+    def _dele(self, s, arg) -> None:
+        filename = self._path(s, arg)
+        if not self._remount_rw(filename):
+            self._send_msg(s, 20)  # Can't write
+            return
+        try:
             try:
-                self._conn, self._client = self._socket.accept()
-                self._conn.setblocking(False)
-                self._send_msg(3)
-                self._reset_rx_buffer()
-                if self.verbose:
-                    print(
-                        "Connected client from {}:{}".format(
-                            self.client[0], self.client[1]
-                        )
-                    )
-                if not self.authenticated:
-                    self._timer = monotonic()
-            except OSError:  # No connection took place.
-                return False
-        else:
+                self._fs.remove(filename)
+            finally:
+                self._changed(filename)
+                self._remount_ro()
+            self._send_msg(s, 6)  # Command successful
+        except OSError:
+            self._send_msg(s, 18)  # File not found
+
+    def _rmd(self, s, arg) -> None:
+        dirname = self._path(s, arg)
+        if not self._remount_rw(dirname):
+            self._send_msg(s, 20)  # Can't write
+            return
+        try:
             try:
-                tmpconn, tmpclient = self._socket.accept()
-                self._kick(tmpclient)
-                tmpconn.send(_msgs[16] + "\r\n")
-                tmpconn.close()
-                del tmpconn, tmpclient
-            except OSError:
-                pass
-        return True
+                self._fs.rmdir(dirname)
+            finally:
+                self._changed(dirname)
+                self._remount_ro()
+            self._send_msg(s, 6)  # Command successful
+        except OSError:
+            self._send_msg(s, 5)  # Directory not found
 
-    def _reset_rx_buffer(self) -> None:
-        if self.deinited:
+    def _mkd(self, s, arg) -> None:
+        dirname = self._path(s, arg)
+        if not self._remount_rw(dirname):
+            self._send_msg(s, 20)  # Can't write
             return
-        for i in range(len(self._rx_buf)):
-            self._rx_buf[i] = 0
+        try:
+            try:
+                self._fs.mkdir(dirname)
+            finally:
+                self._changed(dirname)
+                self._remount_ro()
+            self._send_msg(s, 6)  # Command successful
+        except OSError:
+            self._send_msg(s, 5)  # Directory not found
 
-    def _reset_file_cache(self) -> None:
-        if self.deinited:
+    def _rnfr(self, s, arg) -> None:
+        s.rename_from = self._path(s, arg)
+        self._send_msg(s, 24)  # Command successful
+
+    def _rnto(self, s, arg) -> None:
+        if s.rename_from == None:
+            self._send_msg(s, 0)  # Invalid request, RNFR missing
+            return
+        rename_to = self._path(s, arg)
+        if not self._remount_rw(rename_to):
+            self._send_msg(s, 20)  # Can't write
             return
-        for i in range(self._max_cache * self._maxbuf):
-            self._file_cache[i] = 0
+        try:
+            try:
+                self._fs.rename(s.rename_from, rename_to)
+            finally:
+                self._changed(None)  # Whole trees may have moved.
+                self._remount_ro()
+            self._send_msg(s, 6)  # Command successful
+        except OSError:
+            self._send_msg(s, 18)  # File not found
+        finally:
+            s.rename_from = None
+
+    def _enable_data(self, s) -> bool:  # If you are using ACTIVE, disable your firewall.
+        # Passive connections get accepted by _step once the client shows up.
+        if s.pasv:
+            return True
+        if self.verbose:
+            print("Connecting to ACTIVE socket..")
+        try:
+            s.data_socket = self._get_sock()
+            s.data_socket.connect((s.data_ip, s.data_port))
+            s.data_socket.setblocking(False)
+        except (OSError, TypeError):
+            self._disable_data(s)
+            self._send_msg(s, 28)
+            return False
+        if self.verbose:
+            print("Enabled ACTIVE.")
+        return True
 
-    def _authcheck(self) -> bool:
-        if not self.authenticated:
-            self._send_msg(7)
-        return self.authenticated
+    def _accept_data(self, s) -> bool:
+        if s.pasv_sock is None:
+            return False
+        try:
+            conn, client = s.pasv_sock.accept()
+        except OSError:
+            return False
+        if client[0] != s.client[0]:  # Not our client, someone is port scanning.
+            conn.close()
+            return False
+        s.data_socket = conn
+        s.data_socket.setblocking(False)
+        if self.verbose:
+            print("Enabled PASV.")
+        return True
 
-    def _logon(self) -> None:
+    def _disable_data(self, s):
         if self.verbose:
-            print(
-                "Logged in {} from {}:{}".format(
-                    self._tmpuser, self.client[0], self.client[1]
-                )
-            )
+            print("Disabled data socket")
+        self._reset_data_sock(s)
+
+    def _connect(self) -> None:
+        try:
+            conn, client = self._socket.accept()
+        except OSError:  # No connection took place.
+            return
+        slot = None
+        for i in range(len(self._sessions)):
+            if self._sessions[i] is None:
+                slot = i
+                break
+        if slot is None:
+            self._kick(client)
+            self.metrics.kicked += 1
+            try:
+                conn.send(_msgs[16])
+            except OSError:
+                pass
+            conn.close()
+            return
+        conn.setblocking(False)
+        try:  # Replies are small, don't let them wait on delayed acks.
+            conn.setsockopt(self._pool.IPPROTO_TCP, self._pool.TCP_NODELAY, 1)
+        except (AttributeError, OSError):
+            pass
+        s = session(conn, client, slot, not bool(len(self._authlist)), self.mode)
+        self._sessions[slot] = s
+        if self._cur is None:
+            self._cur = s
+        self._send_msg(s, 3)
+        if self.verbose:
+            print("Connected client from {}:{}".format(client[0], client[1]))
+
+    def _logon(self, s) -> None:
+        if self.verbose:
+            print("Logged in {} from {}:{}".format(s.user, s.client[0], s.client[1]))
 
     def _kick(self, cl) -> None:
         if self.verbose:
             print("Kicked {}:{}".format(cl[0], cl[1]))
         del cl
 
-    def _reset_data_sock(self) -> None:
+    def _reset_data_sock(self, s) -> None:
         if self.deinited:
             return
-        if self._data_socket is not None:
+        if s.data_socket is not None:
             try:
-                self._data_socket.close()
+                s.data_socket.close()
             except:
                 pass
-            self._data_socket = None
-        if self.pasv:
-            if self._pasv_sock is not None:
-                try:
-                    self._pasv_sock.close()
-                except:
-                    pass
-                self._pasv_sock = None
-        else:
-            self._data_socket = self._get_sock()
-            self._data_socket.bind(self._iptup)
-            self._data_socket.listen(1)
+            s.data_socket = None
 
-    def _send_msg(self, no) -> None:
-        self._s_send(_msgs[no] + b"\r\n")
+    def _send_msg(self, s, no) -> None:
+        self._s_send(s, _msgs[no])
 
-    def _ensure_conn(self) -> bool:
-        if not self.connected:
-            return False
+    def _ensure_conn(self, s) -> bool:
         try:
-            if monotonic() - self._pollt > 1:
-                self._conn.send(b"")
-                self._pollt = monotonic()
+            if monotonic() - s.pollt > 1:
+                s.conn.send(b"")
+                s.pollt = monotonic()
         except:
-            self.disconnect()
+            self._drop(s)
             return True
         return False
 
@@ -815,3 +3233,50 @@ class ftp:
         except AttributeError:
             pass
         return sock
+
+
+_cmds = {  # verb: (handler, flags)
+    "user": (ftp._user, _C_ARG),
+    "pass": (ftp._pass, 0),
+    "syst": (ftp._syst, _C_AUTH),
+    "pwd": (ftp._pwd, _C_AUTH),
+    "cwd": (ftp._cwd, _C_AUTH | _C_ARG),
+    "cdup": (ftp._cdup, _C_AUTH),
+    "list": (ftp._list, _C_AUTH),
+    "nlst": (ftp._nlst, _C_AUTH),
+    "nlist": (ftp._nlst, _C_AUTH),
+    "mlsd": (ftp._mlsd, _C_AUTH),
+    "mlst": (ftp._mlst, _C_AUTH),
+    "feat": (ftp._feat, 0),
+    "port": (ftp._port, _C_AUTH | _C_ARG),
+    "size": (ftp._size, _C_AUTH | _C_ARG),
+    "type": (ftp._type, _C_AUTH | _C_ARG),
+    "mode": (ftp._mode, _C_AUTH | _C_ARG),
+    "pasv": (ftp._enpasv, _C_AUTH),
+    "noop": (ftp._noop, _C_ANYTIME),
+    "retr": (ftp._retr, _C_AUTH | _C_ARG),
+    "stor": (ftp._stor, _C_AUTH | _C_ARG | _C_WRITE),
+    "appe": (ftp._appe, _C_AUTH | _C_ARG | _C_WRITE),
+    "dele": (ftp._dele, _C_AUTH | _C_ARG | _C_WRITE),
+    "rmd": (ftp._rmd, _C_AUTH | _C_ARG | _C_WRITE),
+    "mkd": (ftp._mkd, _C_AUTH | _C_ARG | _C_WRITE),
+    "rnfr": (ftp._rnfr, _C_AUTH | _C_ARG),
+    "rnto": (ftp._rnto, _C_AUTH | _C_ARG | _C_WRITE),
+    "rest": (ftp._rest, _C_AUTH | _C_ARG),
+    "site": (ftp._site, _C_AUTH | _C_ARG),
+    "hash": (ftp._hash, _C_AUTH | _C_ARG),
+    "xcrc": (ftp._xcrc, _C_AUTH | _C_ARG),
+    "xsha256": (ftp._xsha256, _C_AUTH | _C_ARG),
+    "opts": (ftp._opts, _C_ARG),
+    "quit": (ftp._quit, _C_ANYTIME),
+}
+
+# SITE subcommands
+_site_cmds = {
+    "stats": (ftp._site_stats, 0),
+    "cpfr": (ftp._site_cpfr, _C_ARG),
+    "cpto": (ftp._site_cpto, _C_ARG | _C_WRITE),
+    "copy": (ftp._site_copy, _C_ARG | _C_WRITE),
+    "retrtar": (ftp._site_retrtar, _C_ARG),
+    "stortar": (ftp._site_stortar, _C_ARG | _C_WRITE),
+}